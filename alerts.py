@@ -0,0 +1,120 @@
+import itertools
+import json
+import threading
+
+import fleet
+import latest
+import spatial
+from geometry import haversine
+
+# Caps how many grid cells one alert occupies.
+MAX_RADIUS_M = 2000
+
+
+class Alert:
+    __slots__ = ('id', 'topic', 'latitude', 'longitude', 'radius', 'sub', 'cells')
+
+    def __init__(self, id, topic, latitude, longitude, radius, sub):
+        self.id = id
+        self.topic = topic
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius = radius
+        self.sub = sub
+        self.cells = ()
+
+    def contains(self, lat, lng):
+        return haversine(self.latitude, self.longitude, lat, lng) <= self.radius
+
+
+class AlertEngine:
+    """Proximity alerts ('bus:<no>' or 'route:<no>' within a radius of a point).
+
+    Each alert is filed under every grid cell its circle touches, keyed by
+    topic, so a ping only checks alerts for its own bus and route in its own
+    cell, however many alerts exist elsewhere. An alert fires when a bus
+    enters its circle and re-arms once the bus leaves.
+    """
+
+    def __init__(self, store):
+        self._lock = threading.Lock()
+        self._cells = {}
+        self._alerts = {}
+        self._inside = {}
+        self._ids = itertools.count(1)
+        self.fired = 0
+        self.checked = 0
+        store.add_listener(self.evaluate)
+
+    def add(self, topic, latitude, longitude, radius, sub):
+        alert = Alert(next(self._ids), topic, latitude, longitude, min(radius, MAX_RADIUS_M), sub)
+        alert.cells = tuple(spatial.cells_around(latitude, longitude, alert.radius))
+        with self._lock:
+            self._alerts[alert.id] = alert
+            for cell in alert.cells:
+                self._cells.setdefault(cell, {}).setdefault(topic, set()).add(alert)
+        return alert
+
+    def remove(self, alert):
+        with self._lock:
+            if self._alerts.pop(alert.id, None) is None:
+                return
+            for cell in alert.cells:
+                topics = self._cells[cell]
+                topics[alert.topic].discard(alert)
+                if not topics[alert.topic]:
+                    del topics[alert.topic]
+                if not topics:
+                    del self._cells[cell]
+            for bus_no in [b for b, inside in self._inside.items() if alert in inside]:
+                self._inside[bus_no].discard(alert)
+                if not self._inside[bus_no]:
+                    del self._inside[bus_no]
+
+    def evaluate(self, state):
+        # Runs under the latest store's lock: no database access here.
+        if not self._alerts:
+            return
+        topics = ['bus:%s' % state.bus_no]
+        route_no = fleet.assignments.route_of(state.bus_no, load=False)
+        if route_no is not None:
+            topics.append('route:%s' % route_no)
+        lat, lng = state.latitude, state.longitude
+        with self._lock:
+            bucket = self._cells.get(spatial.cell_of(lat, lng), {})
+            candidates = set()
+            for topic in topics:
+                candidates.update(bucket.get(topic, ()))
+            inside = self._inside.get(state.bus_no, set())
+            # Alerts the bus was inside may live in cells it has since left.
+            candidates.update(inside)
+            self.checked += len(candidates)
+            entered = []
+            for alert in candidates:
+                if alert.contains(lat, lng):
+                    if alert not in inside:
+                        inside.add(alert)
+                        entered.append(alert)
+                else:
+                    inside.discard(alert)
+            if inside:
+                self._inside[state.bus_no] = inside
+            else:
+                self._inside.pop(state.bus_no, None)
+            self.fired += len(entered)
+        for alert in entered:
+            alert.sub.push(state.bus_no, json.dumps(dict(
+                state.as_dict(), alert_id=alert.id,
+                distance_m=round(haversine(alert.latitude, alert.longitude, lat, lng), 1))))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'alerts': len(self._alerts),
+                'cells': len(self._cells),
+                'fired': self.fired,
+                'checked': self.checked,
+            }
+
+
+engine = AlertEngine(latest.store)
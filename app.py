@@ -1,43 +1,50 @@
-from flask import Flask, request, jsonify, render_template
-import sqlite3
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
+import json
 import os
+import time
+
+import alerts
+import db
+import eta
+import export
+import fleet
+import geometry
+import history
+import ingest
+import latest
+import listing
+import metrics
+import packed
+import partitions
+import predict
+import pubsub
+import replica
+import spatial
+import stopevents
+import storage
 
 app = Flask(__name__)
-DB_FILE = 'routes.db'
+replica.init_app(app)
+metrics.init_app(app)
 
 
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-
-    c.execute('''CREATE TABLE IF NOT EXISTS routes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        route_no TEXT NOT NULL,
-        path TEXT NOT NULL
-    )''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS buses (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        bus_no TEXT NOT NULL,
-        route_no TEXT NOT NULL
-    )''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS gps_data (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        bus_no TEXT,
-        latitude REAL,
-        longitude REAL,
-        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-    )''')
-
-    c.execute('''CREATE TABLE IF NOT EXISTS bus_status (
-        bus_no TEXT PRIMARY KEY,
-        air_quality INTEGER,
-        passenger_count INTEGER
-    )''')
-
-    conn.commit()
-    conn.close()
+    storage.migrate()
+
+# Stop events, export and compaction work on SQLite's per-day partitions.
+SQLITE_ONLY = ('/stop_events/', '/export/')
+
+@app.before_request
+def start_background_jobs():
+    if storage.BACKEND != 'sqlite':
+        return
+    partitions.compactor.ensure_started()
+    stopevents.processor.ensure_started()
+
+@app.before_request
+def refuse_sqlite_only():
+    if storage.BACKEND != 'sqlite' and request.path.startswith(SQLITE_ONLY):
+        return jsonify({'error': 'Not available with SMARTBUS_STORAGE=%s' % storage.BACKEND}), 501
 
 @app.route('/')
 def home():
@@ -62,20 +69,20 @@ def add_route():
     data = request.get_json()
     route_no = data['route_no']
     path = data['path']
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('INSERT INTO routes (route_no, path) VALUES (?, ?)', (route_no, path))
-    conn.commit()
-    conn.close()
+    try:
+        storage.routes.add(route_no, path)
+    except storage.Conflict:
+        return jsonify({'error': 'Route already exists'}), 409
+    geometry.routes.invalidate()
+    listing.cache.invalidate()
     return jsonify({'message': 'Route added'})
 
 @app.route('/get_routes')
 def get_routes():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('SELECT * FROM routes')
-    rows = c.fetchall()
-    conn.close()
+    if request.args.get('parsed'):
+        # Stops already parsed server-side, instead of the raw path JSON.
+        return jsonify([g.as_dict() for g in geometry.routes.all()])
+    rows = storage.routes.all()
     return jsonify([{'id': r[0], 'route_no': r[1], 'path': r[2]} for r in rows])
 
 # ------------------ Bus API ------------------
@@ -85,32 +92,64 @@ def add_bus():
     data = request.get_json()
     bus_no = data['bus_no']
     route_no = data['route_no']
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('INSERT INTO buses (bus_no, route_no) VALUES (?, ?)', (bus_no, route_no))
-    conn.commit()
-    conn.close()
+    try:
+        storage.buses.add(bus_no, route_no)
+    except storage.Conflict:
+        return jsonify({'error': 'Bus already exists'}), 409
+    fleet.assignments.invalidate()
+    listing.cache.invalidate()
     return jsonify({'message': 'Bus added'})
 
 @app.route('/get_buses')
 def get_buses():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('SELECT * FROM buses')
-    rows = c.fetchall()
-    conn.close()
+    rows = storage.buses.all()
     return jsonify([{'id': r[0], 'bus_no': r[1], 'route_no': r[2]} for r in rows])
 
 @app.route('/delete_bus/<int:bus_id>', methods=['DELETE'])
 def delete_bus(bus_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute('DELETE FROM buses WHERE id = ?', (bus_id,))
-    conn.commit()
-    conn.close()
+    storage.buses.delete(bus_id)
+    fleet.assignments.invalidate()
+    listing.cache.invalidate()
     return jsonify({'message': 'Bus deleted'})
 
+@app.route('/routes_buses/data')
+def routes_buses_data():
+    q = request.args.get('q', '').strip() or None
+    fmt = request.args.get('format', 'json')
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(listing.MAX_PER_PAGE, max(1, int(request.args.get('per_page', 50))))
+    except ValueError:
+        return jsonify({'error': 'page and per_page must be integers'}), 400
+    if fmt not in ('json', 'html'):
+        return jsonify({'error': 'format must be json or html'}), 400
+
+    def render():
+        total, rows = storage.buses.search(q, page, per_page)
+        if fmt == 'html':
+            body = render_template('_routes_buses_rows.html', rows=rows)
+            mimetype = 'text/html'
+        else:
+            body = json.dumps({'total': total, 'page': page, 'per_page': per_page, 'rows': rows})
+            mimetype = 'application/json'
+        return body, mimetype, total
+
+    body, mimetype, total = listing.cache.get_or_render((q, page, per_page, fmt), render)
+    return Response(body, mimetype=mimetype, headers={'X-Total-Count': str(total)})
+
 # ------------------ GPS & Live Data ------------------
+
+def submit_pings(pings):
+    try:
+        ingest.writer.submit_many(pings)
+    except ingest.QueueFull as e:
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    for ping in pings:
+        latest.store.update(ping)
+    return None
+
 @app.route('/update_bus_data', methods=['GET', 'POST'])
 def update_bus_data():
     if request.method == 'GET':
@@ -130,43 +169,77 @@ def update_bus_data():
     if not all([bus_no, latitude, longitude]):
         return jsonify({'error': 'Missing data'}), 400
 
+    # The same checks as a batch fix, so NaN or out-of-range coordinates never
+    # reach storage or the latest-store listeners.
+    now = time.time()
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-
-        c.execute('INSERT INTO gps_data (bus_no, latitude, longitude) VALUES (?, ?, ?)',
-                  (bus_no, latitude, longitude))
-
-        c.execute('''
-            INSERT INTO bus_status (bus_no, air_quality, passenger_count)
-            VALUES (?, ?, ?)
-            ON CONFLICT(bus_no) DO UPDATE SET
-            air_quality = excluded.air_quality,
-            passenger_count = excluded.passenger_count
-        ''', (bus_no, air_quality, passenger_count))
+        ping = ingest.parse_fix({'bus_no': bus_no, 'latitude': latitude, 'longitude': longitude,
+                                 'air_quality': air_quality, 'passenger_count': passenger_count},
+                                now, ingest.utc_timestamp(now))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    error = submit_pings([ping])
+    if error:
+        return error
+    if ingest.writer.mode == 'async':
+        return jsonify({'status': 'queued'}), 202
+    return jsonify({'status': 'updated'})
+
+@app.route('/update_bus_data/batch', methods=['POST'])
+def update_bus_data_batch():
+    # A JSON array of fixes, or one JSON object per line for NDJSON.
+    try:
+        if request.mimetype == 'application/x-ndjson':
+            records = [json.loads(line) for line in request.get_data(as_text=True).splitlines()
+                       if line.strip()]
+        else:
+            records = request.get_json(force=True)
+    except ValueError:
+        return jsonify({'error': 'Body is not valid JSON or NDJSON'}), 400
+    if not isinstance(records, list):
+        return jsonify({'error': 'Expected an array of fixes'}), 400
+    if len(records) > ingest.BATCH_LIMIT:
+        return jsonify({'error': 'At most %d fixes per batch' % ingest.BATCH_LIMIT}), 413
+
+    now = time.time()
+    received = ingest.utc_timestamp(now)
+    pings, results = [], []
+    for record in records:
+        try:
+            pings.append(ingest.parse_fix(record, now, received))
+            results.append({'status': 'accepted'})
+        except ValueError as e:
+            results.append({'status': 'rejected', 'error': str(e)})
+
+    if pings:
+        error = submit_pings(pings)
+        if error:
+            return error
+    return jsonify({
+        'accepted': len(pings),
+        'rejected': len(records) - len(pings),
+        'results': results,
+    })
+
+@app.route('/ingest/binary', methods=['POST'])
+def ingest_binary():
+    try:
+        pings = packed.decode(request.get_data(cache=False))
+    except packed.DecodeError as e:
+        return jsonify({'error': str(e)}), 400
 
-        conn.commit()
-        conn.close()
-        return jsonify({'status': 'updated'})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    error = submit_pings(pings)
+    if error:
+        return error
+    return jsonify({'accepted': len(pings)}), 202 if ingest.writer.mode == 'async' else 200
 
 @app.route('/get_bus_location/<bus_no>')
 def get_bus_location(bus_no):
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute('''
-            SELECT latitude, longitude 
-            FROM gps_data 
-            WHERE bus_no = ? 
-            ORDER BY timestamp DESC 
-            LIMIT 1
-        ''', (bus_no,))
-        row = c.fetchone()
-        conn.close()
-        if row:
-            return jsonify({'latitude': row[0], 'longitude': row[1]})
+        state = latest.store.get(bus_no)
+        if state:
+            return jsonify({'latitude': state.latitude, 'longitude': state.longitude})
         else:
             return jsonify({'error': 'No GPS data found for this bus'}), 404
     except Exception as e:
@@ -177,47 +250,232 @@ def get_bus_location(bus_no):
 @app.route('/get_bus_status/<bus_no>')
 def get_bus_status(bus_no):
     try:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        
-        # Get latest location
-        c.execute('''
-            SELECT latitude, longitude 
-            FROM gps_data 
-            WHERE bus_no = ? 
-            ORDER BY timestamp DESC 
-            LIMIT 1
-        ''', (bus_no,))
-        gps_row = c.fetchone()
-
-        # Get AQI + passenger count
-        c.execute('SELECT air_quality, passenger_count FROM bus_status WHERE bus_no = ?', (bus_no,))
-        status_row = c.fetchone()
-
-        conn.close()
-
-        if gps_row and status_row:
+        state = latest.store.get(bus_no)
+        if state:
             return jsonify({
                 'bus_no': bus_no,
-                'latitude': gps_row[0],
-                'longitude': gps_row[1],
-                'air_quality': status_row[0],
-                'passenger_count': status_row[1]
+                'latitude': state.latitude,
+                'longitude': state.longitude,
+                'air_quality': state.air_quality,
+                'passenger_count': state.passenger_count
             })
         else:
             return jsonify({'error': 'No data found for this bus'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ------------------ Fleet ------------------
+
+@app.route('/fleet/snapshot')
+def fleet_snapshot():
+    route_no = request.args.get('route_no')
+    columnar = request.args.get('format') == 'columnar'
+    try:
+        bbox = fleet.parse_bbox(request.args.get('bbox'))
+    except ValueError:
+        return jsonify({'error': 'bbox must be west,south,east,north'}), 400
+
+    bus_nos = fleet.assignments.buses_on(route_no) if route_no else None
+
+    version, states = latest.store.snapshot()
+    tag = fleet.etag(version, route_no, bus_nos, bbox, columnar)
+    if request.if_none_match.contains_weak(tag):
+        return '', 304, {'ETag': 'W/"%s"' % tag}
+
+    response = jsonify(fleet.encode(fleet.select(states, bus_nos, bbox), columnar))
+    response.set_etag(tag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# ------------------ ETA ------------------
+
+@app.route('/predict/bus/<bus_no>')
+def predict_bus(bus_no):
+    # Speed and heading let clients animate between polls on their own.
+    result = predict.predict(bus_no)
+    if result is None:
+        return jsonify({'error': 'No GPS data found for this bus'}), 404
+    return jsonify(result)
+
+@app.route('/eta/bus/<bus_no>')
+def eta_for_bus(bus_no):
+    entry = eta.engine.for_bus(bus_no)
+    if entry is None:
+        return jsonify({'error': 'No position or route for this bus'}), 404
+    return jsonify(entry)
+
+@app.route('/eta/stop/<stop>')
+def eta_for_stop(stop):
+    return jsonify({'stop': stop, 'arrivals': eta.engine.for_stop(stop, request.args.get('route_no'))})
+
+# ------------------ Stop Events ------------------
+
+def stop_event_args():
+    start = ingest.utc_timestamp(ingest.to_epoch(request.args['from'])) if 'from' in request.args else None
+    end = ingest.utc_timestamp(ingest.to_epoch(request.args['to'])) if 'to' in request.args else None
+    limit = min(max(1, int(request.args.get('limit', 100))), stopevents.MAX_LIMIT)
+    return start, end, limit
+
+@app.route('/stop_events/route/<route_no>')
+def route_stop_events(route_no):
+    try:
+        start, end, limit = stop_event_args()
+        stop = int(request.args['stop']) if 'stop' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'from/to must be unix seconds or ISO 8601; stop and limit integers'}), 400
+    return jsonify(stopevents.events(replica.get_db(), route_no, stop, request.args.get('bus_no'),
+                                     start, end, limit))
+
+@app.route('/stop_events/route/<route_no>/<int:stop_index>/headways')
+def stop_headways(route_no, stop_index):
+    try:
+        start, end, limit = stop_event_args()
+    except ValueError:
+        return jsonify({'error': 'from/to must be unix seconds or ISO 8601; limit an integer'}), 400
+    return jsonify({'route_no': route_no, 'stop_index': stop_index,
+                    'arrivals': stopevents.headways(replica.get_db(), route_no, stop_index,
+                                                    start, end, limit)})
+
+@app.route('/stop_events/stats')
+def stop_event_stats():
+    return jsonify(stopevents.processor.stats())
+
+# ------------------ Nearby ------------------
+
+def nearby_args():
+    lat = float(request.args['lat'])
+    lng = float(request.args['lng'])
+    radius = min(float(request.args.get('radius', 500)), spatial.MAX_RADIUS_M)
+    limit = int(request.args.get('limit', 50))
+    return lat, lng, radius, limit
+
+@app.route('/nearby/buses')
+def nearby_buses():
+    try:
+        lat, lng, radius, limit = nearby_args()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'lat and lng are required; radius in metres'}), 400
+    return jsonify([{'bus_no': bus_no, 'latitude': blat, 'longitude': blng,
+                     'distance_m': round(d, 1)}
+                    for d, bus_no, blat, blng, _ in spatial.buses.near(lat, lng, radius, limit)])
+
+@app.route('/nearby/stops')
+def nearby_stops():
+    try:
+        lat, lng, radius, limit = nearby_args()
+    except (KeyError, ValueError):
+        return jsonify({'error': 'lat and lng are required; radius in metres'}), 400
+    return jsonify([{'name': name, 'route_no': route_no, 'lat': slat, 'lng': slng,
+                     'distance_m': round(d, 1)}
+                    for d, (route_no, _), slat, slng, name in spatial.stops.near(lat, lng, radius, limit)])
+
+# ------------------ History ------------------
+
+@app.route('/history/<bus_no>')
+def bus_history(bus_no):
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in history.FORMATS:
+        return jsonify({'error': 'format must be one of %s' % ', '.join(history.FORMATS)}), 400
+    now = time.time()
+    try:
+        end = ingest.to_epoch(request.args['to']) if 'to' in request.args else now
+        start = ingest.to_epoch(request.args['from']) if 'from' in request.args else end - end % 86400
+        start, end = ingest.utc_timestamp(start), ingest.utc_timestamp(end)
+        tolerance = float(request.args.get('simplify', 0))
+    except ValueError:
+        return jsonify({'error': 'from/to must be unix seconds or ISO 8601, simplify in metres'}), 400
+
+    chunks = history.stream(bus_no, start, end, tolerance, fmt)
+    return Response(chunks, mimetype=history.FORMATS[fmt][0])
+
+# ------------------ Export ------------------
+
+@app.route('/export/run', methods=['POST'])
+def export_run():
+    # Starts the run and returns; poll /export/status for the result.
+    if not export.exporter.start():
+        return jsonify({'error': 'An export is already running'}), 409
+    return jsonify(export.exporter.status()), 202
+
+@app.route('/export/status')
+def export_status():
+    return jsonify(export.exporter.status())
+
+@app.route('/export/gps')
+def export_gps():
+    # Pull-based incremental export: pass back X-Export-Through-Id as after_id.
+    try:
+        after = int(request.args.get('after_id', 0))
+    except ValueError:
+        return jsonify({'error': 'after_id must be an integer'}), 400
+    conn = replica.get_db()
+    through = conn.execute('SELECT last_id FROM gps_sequence').fetchone()[0]
+    return Response(stream_with_context(export.stream_csv(after, through)), mimetype='text/csv',
+                    headers={'X-Export-Through-Id': str(through)})
+
+# ------------------ Live Streams ------------------
+
+def sse_response(topics, initial, sub=None, **kwargs):
+    sub = sub or pubsub.broker.subscribe(topics)
+    return Response(stream_with_context(pubsub.event_stream(sub, initial, **kwargs)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/stream/bus/<bus_no>')
+def stream_bus(bus_no):
+    state = latest.store.get(bus_no)
+    return sse_response(['bus:' + bus_no], [state] if state else [])
+
+@app.route('/stream/route/<route_no>')
+def stream_route(route_no):
+    states = [latest.store.get(b) for b in fleet.assignments.buses_on(route_no)]
+    return sse_response(['route:' + route_no], [s for s in states if s])
+
+@app.route('/stream/alerts')
+def stream_alerts():
+    # The stream is the subscription: it lives as long as the connection.
+    bus_no, route_no = request.args.get('bus_no'), request.args.get('route_no')
+    try:
+        lat, lng = float(request.args['lat']), float(request.args['lng'])
+        radius = float(request.args.get('radius', 300))
+    except (KeyError, ValueError):
+        return jsonify({'error': 'lat and lng are required; radius in metres'}), 400
+    if bool(bus_no) == bool(route_no):
+        return jsonify({'error': 'Give exactly one of bus_no or route_no'}), 400
+    topic = 'bus:' + bus_no if bus_no else 'route:' + route_no
+
+    sub = pubsub.broker.subscribe(['alert:' + topic])
+    alert = alerts.engine.add(topic, lat, lng, radius, sub)
+    return sse_response(None, [], sub=sub, event='alert',
+                        on_close=lambda: alerts.engine.remove(alert))
+
 @app.route('/init')
 def manual_init():
     init_db()
     return "✅ Database initialized"
 
+@app.route('/db/stats')
+def db_stats():
+    return jsonify(dict(db.pool.stats(), reader=replica.replica.stats(),
+                        writer=storage.telemetry.stats()))
+
+@app.route('/ingest/stats')
+def ingest_stats():
+    return jsonify(ingest.writer.stats())
+
+@app.route('/stream/stats')
+def stream_stats():
+    return jsonify(dict(pubsub.broker.stats(), alerts=alerts.engine.stats()))
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 
 
 # ------------------ Init ------------------
 
 if __name__ == '__main__':
+    metrics.registry.clear()
     init_db()
     app.run(debug=True)
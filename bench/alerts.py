@@ -0,0 +1,57 @@
+"""Per-ping proximity alert evaluation cost as the number of alerts grows.
+
+Run from the repository root:
+
+    python bench/alerts.py --alerts 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import alerts  # noqa: E402
+import latest  # noqa: E402
+import pubsub  # noqa: E402
+
+SOUTH, WEST, SPAN = 12.83, 77.45, 0.27
+
+
+def timed(engine, pings):
+    start = time.perf_counter()
+    for state in pings:
+        engine.evaluate(state)
+    return (time.perf_counter() - start) / len(pings) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--alerts', type=int, default=100000)
+    parser.add_argument('--buses', type=int, default=2000)
+    parser.add_argument('--radius', type=float, default=300)
+    parser.add_argument('--pings', type=int, default=50000)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    pings = [latest.BusState('KA-%04d' % rng.randrange(args.buses),
+                             rng.uniform(SOUTH, SOUTH + SPAN), rng.uniform(WEST, WEST + SPAN),
+                             '2024-01-01 00:00:00.000', None, None)
+             for _ in range(args.pings)]
+
+    engine = alerts.AlertEngine(latest.LatestStore())
+    sub = pubsub.Subscription([])
+    count = 0
+    for size in (1000, 10000, args.alerts):
+        while count < size:
+            engine.add('bus:KA-%04d' % rng.randrange(args.buses),
+                       rng.uniform(SOUTH, SOUTH + SPAN), rng.uniform(WEST, WEST + SPAN),
+                       args.radius, sub)
+            count += 1
+        print('%7d alerts: %6.2f us/ping' % (size, timed(engine, pings)))
+    print(engine.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Latest-location query time against a large gps_data, before and after migrations.
+
+Run from the repository root (10M rows takes a few minutes to generate):
+
+    python bench/latest_location.py --rows 10000000 --buses 500
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import migrations  # noqa: E402
+
+LATEST_FROM_HISTORY = '''
+    SELECT latitude, longitude FROM gps_data
+    WHERE bus_no = ? ORDER BY timestamp DESC LIMIT 1
+'''
+LATEST_FROM_TABLE = 'SELECT latitude, longitude FROM bus_latest WHERE bus_no = ?'
+
+
+def populate(conn, rows, buses):
+    migrations._baseline(conn)
+    conn.execute('''
+        WITH RECURSIVE seq(n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM seq WHERE n < ?)
+        INSERT INTO gps_data (bus_no, latitude, longitude, timestamp)
+        SELECT printf('KA-%04d', n % ?),
+               12.9 + (n % 1000) * 1e-4,
+               77.5 + (n % 997) * 1e-4,
+               datetime(1700000000 + n / ?, 'unixepoch')
+        FROM seq
+    ''', (rows - 1, buses, buses))
+    conn.commit()
+
+
+def timed(conn, sql, buses, lookups):
+    start = time.perf_counter()
+    for i in range(lookups):
+        conn.execute(sql, ('KA-%04d' % (i % buses),)).fetchone()
+    return (time.perf_counter() - start) / lookups * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--buses', type=int, default=500)
+    parser.add_argument('--lookups', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=OFF')
+
+        start = time.perf_counter()
+        populate(conn, args.rows, args.buses)
+        print('generated %d rows in %.1fs' % (args.rows, time.perf_counter() - start))
+
+        # Unindexed scans are slow, so fewer lookups here.
+        before = timed(conn, LATEST_FROM_HISTORY, args.buses, max(1, args.lookups // 10))
+        conn.execute('PRAGMA user_version = 1')
+
+        start = time.perf_counter()
+        migrations.migrate(conn)
+        print('migrated in %.1fs' % (time.perf_counter() - start))
+
+        indexed = timed(conn, LATEST_FROM_HISTORY, args.buses, args.lookups * 100)
+        table = timed(conn, LATEST_FROM_TABLE, args.buses, args.lookups * 100)
+        conn.close()
+
+    print('gps_data, no index:       %10.3f ms/query' % before)
+    print('gps_data, indexed:        %10.3f ms/query' % indexed)
+    print('bus_latest primary key:   %10.3f ms/query' % table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+"""Load test for the ingest and read APIs on a synthetic fleet.
+
+Builds M routes with realistic stop lists and N buses on a fresh database,
+then runs one phase per endpoint:
+
+    update_bus_data   POST fixes of buses moving along their routes
+    get_bus_location  GET the position of a random bus
+    get_routes        GET every route
+
+Phases run against the app in-process (Flask test client) or under
+gunicorn, either as fast as possible or open-loop at --rate requests/s.
+At a fixed rate, latency is measured from each request's scheduled start,
+so a stalled server is not hidden by requests that were sent late. Each
+phase reports throughput, p50/p99 latency and database file growth. The
+results go to a JSON file named after the commit, so runs can be compared
+with --compare.
+
+Run from the repository root:
+
+    python bench/load.py --buses 500 --routes 40 --requests 5000
+    python bench/load.py --target gunicorn --workers 4 --rate 1000
+    python bench/load.py --compare bench/results/<older commit>.json
+"""
+import argparse
+import http.client
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import shlex
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import geometry  # noqa: E402
+
+PHASES = ('update_bus_data', 'get_bus_location', 'get_routes')
+CENTRE = (12.9716, 77.5946)
+SPEED_MPS = 8.0
+
+
+def procfile_worker(path=os.path.join(ROOT, 'Procfile')):
+    """(worker class, worker connections) of the Procfile's web process, so the
+    gunicorn target benchmarks what is deployed; gunicorn's defaults otherwise."""
+    worker_class, connections = 'sync', None
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return worker_class, connections
+    for line in lines:
+        if not line.startswith('web:'):
+            continue
+        # --flag=value and --flag value alike.
+        words = [part for word in shlex.split(line[4:])
+                 for part in (word.split('=', 1) if word.startswith('--') else [word])]
+        for flag, value in zip(words, words[1:]):
+            if flag in ('-k', '--worker-class'):
+                worker_class = value
+            elif flag == '--worker-connections':
+                connections = int(value)
+    return worker_class, connections
+
+
+def synthetic_routes(count, rng, stops=(12, 30), spacing_m=(250, 600)):
+    """[(route_no, path JSON)], each a meandering line of stops near CENTRE."""
+    routes = []
+    for r in range(count):
+        lat = CENTRE[0] + rng.uniform(-0.08, 0.08)
+        lng = CENTRE[1] + rng.uniform(-0.08, 0.08)
+        heading = rng.uniform(0, 2 * math.pi)
+        path = []
+        for s in range(rng.randint(*stops)):
+            path.append({'name': 'R%d Stop %d' % (r + 1, s + 1),
+                         'lat': round(lat, 6), 'lng': round(lng, 6)})
+            heading += rng.uniform(-0.6, 0.6)
+            step = rng.uniform(*spacing_m)
+            lat += step * math.cos(heading) / 111320.0
+            lng += step * math.sin(heading) / (111320.0 * math.cos(math.radians(lat)))
+        routes.append(('R%d' % (r + 1), json.dumps(path)))
+    return routes
+
+
+def synthetic_fleet(count, routes):
+    """[(bus_no, route_no)], spread round-robin over the routes."""
+    return [('KA-%05d' % (b + 1), routes[b % len(routes)][0]) for b in range(count)]
+
+
+class Fleet:
+    """Positions of every bus as it drives its route, looping at the end."""
+
+    def __init__(self, routes, buses, rng):
+        shapes = {route_no: geometry.RouteGeometry.from_path(0, route_no, path)
+                  for route_no, path in routes}
+        self.buses = [(bus_no, shapes[route_no]) for bus_no, route_no in buses]
+        self.offsets = [rng.uniform(0, shape.length) for _, shape in self.buses]
+
+    def fix(self, i, interval):
+        """The i-th fix: buses take turns, each moving interval seconds per turn."""
+        b = i % len(self.buses)
+        bus_no, shape = self.buses[b]
+        along = self.offsets[b] + (i // len(self.buses)) * interval * SPEED_MPS
+        if shape.length:
+            along %= shape.length
+        lat, lng, _ = shape.point_at(along)
+        return {'bus_no': bus_no, 'latitude': round(lat, 6), 'longitude': round(lng, 6),
+                'air_quality': 30 + i % 50, 'passenger_count': i % 60}
+
+
+class InProcessTarget:
+    name = 'inprocess'
+
+    def __init__(self, tmp, ingest_mode):
+        import app as smartbus
+        import db
+        import ingest
+        import metrics
+        import partitions
+
+        self.db_file = os.path.join(tmp, 'load.db')
+        db.pool = db.ConnectionPool(self.db_file)
+        partitions.partitions.forget()
+        metrics.registry = metrics.Registry(os.path.join(tmp, 'metrics'))
+        ingest.writer = ingest.IngestWriter(ingest_mode)
+        smartbus.init_db()
+        self.app = smartbus.app
+        self.ingest = ingest
+        self._local = threading.local()
+
+    def request(self, method, path, body=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        return client.open(path, method=method, json=body).status_code
+
+    def settle(self):
+        while self.ingest.writer.stats()['queued']:
+            time.sleep(0.01)
+        time.sleep(self.ingest.writer.flush_interval * 2)
+
+    def close(self):
+        self.ingest.writer.stop()
+
+
+class GunicornTarget:
+    name = 'gunicorn'
+
+    def __init__(self, tmp, ingest_mode, workers, worker_class, worker_connections=None):
+        self.db_file = os.path.join(tmp, 'load.db')
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        env = dict(os.environ, SMARTBUS_DB=self.db_file, SMARTBUS_INGEST_MODE=ingest_mode,
+                   SMARTBUS_METRICS_DIR=os.path.join(tmp, 'metrics'))
+        self.flush_interval = int(env.get('SMARTBUS_INGEST_FLUSH_MS', '50')) / 1000.0
+        command = [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+                   '--worker-class', worker_class, '--bind', '127.0.0.1:%d' % self.port,
+                   '--log-level', 'warning', 'app:app']
+        if worker_connections:
+            command[-1:-1] = ['--worker-connections', str(worker_connections)]
+        self.process = subprocess.Popen(command, cwd=ROOT, env=env)
+        self._local = threading.local()
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                self.request('GET', '/get_routes')
+                break
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.close()
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.2)
+
+    def request(self, method, path, body=None):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            raise
+        if response.getheader('Connection', '').lower() == 'close':
+            conn.close()
+        return response.status
+
+    def settle(self):
+        # Queues live in the workers; give their writers a few flushes.
+        time.sleep(self.flush_interval * 4 + 0.5)
+
+    def close(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def db_size(db_file):
+    # Checkpoint first so the main file holds everything committed so far;
+    # the WAL's size says more about checkpoint timing than about growth.
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        conn.close()
+    return os.path.getsize(db_file)
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100.0 * len(ordered)) - 1))]
+
+
+def run_phase(target, phase, fleet, requests, concurrency, rate, rng):
+    interval = len(fleet.buses) / rate if rate else 1.0
+    bus_nos = [bus_no for bus_no, _ in fleet.buses]
+    picks = [rng.choice(bus_nos) for _ in range(requests)]
+
+    def call(i):
+        if phase == 'update_bus_data':
+            return target.request('POST', '/update_bus_data', fleet.fix(i, interval))
+        if phase == 'get_bus_location':
+            return target.request('GET', '/get_bus_location/' + picks[i])
+        return target.request('GET', '/get_routes')
+
+    counter = itertools.count()
+    lock = threading.Lock()
+    latencies, statuses = [], {}
+
+    def worker():
+        own, own_statuses = [], {}
+        while True:
+            with lock:
+                i = next(counter)
+            if i >= requests:
+                break
+            scheduled = start + i / rate if rate else None
+            if scheduled is not None:
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            sent = time.perf_counter()
+            try:
+                status = call(i)
+            except (http.client.HTTPException, OSError):
+                status = 'error'
+            own.append(time.perf_counter() - (scheduled if scheduled is not None else sent))
+            own_statuses[status] = own_statuses.get(status, 0) + 1
+        with lock:
+            latencies.extend(own)
+            for status, n in own_statuses.items():
+                statuses[status] = statuses.get(status, 0) + n
+
+    size_before = db_size(target.db_file)
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    target.settle()
+    size_after = db_size(target.db_file)
+
+    latencies.sort()
+    ok = sum(n for status, n in statuses.items() if isinstance(status, int) and status < 400)
+    return {
+        'requests': requests,
+        'ok': ok,
+        'statuses': {str(k): v for k, v in sorted(statuses.items(), key=str)},
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(requests / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+        'db_bytes_before': size_before,
+        'db_bytes_after': size_after,
+        'db_growth_bytes': size_after - size_before,
+        'db_bytes_per_request': round((size_after - size_before) / requests, 1),
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(old, new):
+    for phase, result in new['phases'].items():
+        before = old.get('phases', {}).get(phase)
+        if not before:
+            continue
+        print('%-18s throughput %+6.1f%%   p99 %+6.1f%%' % (
+            phase,
+            (result['throughput_rps'] / before['throughput_rps'] - 1) * 100,
+            (result['p99_ms'] / before['p99_ms'] - 1) * 100 if before['p99_ms'] else 0.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target', choices=('inprocess', 'gunicorn'), default='inprocess')
+    parser.add_argument('--buses', type=int, default=200)
+    parser.add_argument('--routes', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=2000, help='per phase')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='requests/s per phase; 0 sends as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--phases', default=','.join(PHASES))
+    parser.add_argument('--ingest-mode', default=os.environ.get('SMARTBUS_INGEST_MODE', 'group'))
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    worker_class, worker_connections = procfile_worker()
+    parser.add_argument('--worker-class', default=worker_class,
+                        help='gunicorn worker class; default: the Procfile\'s')
+    parser.add_argument('--worker-connections', type=int, default=worker_connections,
+                        help='per-worker connection limit for async workers; default: the Procfile\'s')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='default: bench/results/<commit>-<target>.json')
+    parser.add_argument('--compare', help='an earlier results file to diff against')
+    args = parser.parse_args()
+
+    phases = [p for p in args.phases.split(',') if p]
+    unknown = set(phases) - set(PHASES)
+    if unknown:
+        parser.error('unknown phases: %s' % ', '.join(sorted(unknown)))
+
+    rng = random.Random(args.seed)
+    routes = synthetic_routes(args.routes, rng)
+    buses = synthetic_fleet(args.buses, routes)
+    fleet = Fleet(routes, buses, rng)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.target == 'gunicorn':
+            target = GunicornTarget(tmp, args.ingest_mode, args.workers, args.worker_class,
+                                    args.worker_connections)
+        else:
+            target = InProcessTarget(tmp, args.ingest_mode)
+        try:
+            for route_no, path in routes:
+                target.request('POST', '/add_route', {'route_no': route_no, 'path': path})
+            for bus_no, route_no in buses:
+                target.request('POST', '/add_bus', {'bus_no': bus_no, 'route_no': route_no})
+            results = {}
+            for phase in phases:
+                results[phase] = run_phase(target, phase, fleet, args.requests,
+                                           args.concurrency, args.rate, random.Random(args.seed))
+                print('%-18s %8.1f req/s  p50 %7.2f ms  p99 %7.2f ms  db +%d bytes' % (
+                    phase, results[phase]['throughput_rps'], results[phase]['p50_ms'],
+                    results[phase]['p99_ms'], results[phase]['db_growth_bytes']))
+        finally:
+            target.close()
+
+    report = {
+        'commit': commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'phases': results,
+    }
+    output = args.output or os.path.join(ROOT, 'bench', 'results',
+                                         '%s-%s.json' % (report['commit'], args.target))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to %s' % output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Nearest-bus and nearest-stop query time: grid index against a linear scan.
+
+Run from the repository root:
+
+    python bench/nearby.py --buses 10000 --stops 50000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import spatial  # noqa: E402
+from geometry import haversine  # noqa: E402
+
+# A 30 km square around central Bengaluru.
+SOUTH, WEST, SPAN = 12.83, 77.45, 0.27
+
+
+def random_points(rng, count):
+    return [(rng.uniform(SOUTH, SOUTH + SPAN), rng.uniform(WEST, WEST + SPAN)) for _ in range(count)]
+
+
+def scan(points, lat, lng, radius):
+    found = [(haversine(lat, lng, plat, plng), key) for key, (plat, plng) in enumerate(points)]
+    return sorted(f for f in found if f[0] <= radius)
+
+
+def timed(query, probes, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for lat, lng in probes:
+            query(lat, lng)
+    return (time.perf_counter() - start) / (len(probes) * repeat) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--buses', type=int, default=10000)
+    parser.add_argument('--stops', type=int, default=50000)
+    parser.add_argument('--radius', type=float, default=500)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--moves', type=int, default=100000)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    buses = random_points(rng, args.buses)
+    stops = random_points(rng, args.stops)
+    probes = random_points(rng, args.queries)
+
+    bus_grid, stop_grid = spatial.GridIndex(), spatial.GridIndex()
+    start = time.perf_counter()
+    for key, (lat, lng) in enumerate(buses):
+        bus_grid.update(key, lat, lng)
+    for key, (lat, lng) in enumerate(stops):
+        stop_grid.update(key, lat, lng)
+    print('built grids in %.2fs' % (time.perf_counter() - start))
+
+    # Incremental updates, as the latest-state listener applies them.
+    start = time.perf_counter()
+    for i in range(args.moves):
+        key = i % args.buses
+        lat, lng = buses[key]
+        bus_grid.update(key, lat + rng.uniform(-1e-4, 1e-4), lng + rng.uniform(-1e-4, 1e-4))
+    move_us = (time.perf_counter() - start) / args.moves * 1e6
+
+    for name, points, grid in (('buses', buses, bus_grid), ('stops', stops, stop_grid)):
+        linear = timed(lambda lat, lng: scan(points, lat, lng, args.radius), probes[:20])
+        indexed = timed(lambda lat, lng: grid.near(lat, lng, args.radius), probes, repeat=5)
+        print('%-5s linear scan: %8.3f ms/query' % (name, linear))
+        print('%-5s grid index:  %8.3f ms/query  (%.0fx)' % (name, indexed, linear / indexed))
+    print('bus move:           %8.2f us/update' % move_us)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Writer lock and pool waits while dashboard-style reads run, per read mode.
+
+Run from the repository root:
+
+    python bench/read_contention.py --rows 200000 --readers 4 --seconds 5
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import db  # noqa: E402
+import ingest  # noqa: E402
+import partitions  # noqa: E402
+import replica  # noqa: E402
+import storage  # noqa: E402
+
+HEAVY_READ = 'SELECT bus_no, COUNT(*), AVG(latitude), AVG(longitude) FROM gps_data GROUP BY bus_no'
+
+
+def pings(n, offset=0):
+    now = time.time()
+    return [ingest.Ping('KA-%04d' % (i % 500), 12.9 + (i % 1000) * 1e-4, 77.5 + (i % 997) * 1e-4,
+                        None, None, ingest.utc_timestamp(now - 3600 + (offset + i) * 1e-3))
+            for i in range(n)]
+
+
+def run(mode, db_file, readers, seconds, pool_size):
+    # A short pool timeout so a starved writer shows up as timeouts.
+    db.pool = db.ConnectionPool(db_file, size=pool_size, timeout=1)
+    storage.telemetry = storage.SQLiteTelemetryStore()
+    replica.replica = replica.Replica(mode, staleness=1.0)
+    stop = threading.Event()
+    reads = [0]
+
+    def read():
+        while not stop.is_set():
+            with replica.replica.connection() as conn:
+                conn.execute(HEAVY_READ).fetchall()
+            reads[0] += 1
+
+    threads = [threading.Thread(target=read, daemon=True) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + seconds
+    batch = timeouts = 0
+    while time.monotonic() < deadline:
+        try:
+            storage.telemetry.write(pings(50, batch * 50))
+        except sqlite3.OperationalError:
+            timeouts += 1
+        batch += 1
+    stop.set()
+    for t in threads:
+        t.join()
+    writer, pool = storage.telemetry.stats(), db.pool.stats()
+    db.pool.close()
+    return {
+        'writes_per_s': round(writer['writes'] / seconds, 1),
+        'write_timeouts': timeouts,
+        'reads': reads[0],
+        'lock_wait_ms_avg': round(writer['lock_wait_ms'] / max(writer['writes'], 1), 3),
+        'lock_wait_ms_max': writer['max_lock_wait_ms'],
+        'pool_waits': pool['waits'],
+        'pool_wait_ms': pool['wait_time_ms'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--pool-size', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, 'bench.db')
+        db.pool = db.ConnectionPool(db_file)
+        partitions.partitions.forget()
+        storage.migrate()
+        for offset in range(0, args.rows, 5000):
+            storage.telemetry.write(pings(min(5000, args.rows - offset), offset))
+        db.pool.close()
+
+        for mode in replica.MODES:
+            result = run(mode, db_file, args.readers, args.seconds, args.pool_size)
+            print('%-9s %s' % (mode, result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Per-fix cost of snapping GPS fixes to a route: full scan against the segment grid.
+
+Run from the repository root:
+
+    python bench/snap.py --stops 200 --fixes 50000
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import geometry  # noqa: E402
+
+
+def make_route(rng, stops):
+    # A meandering route with stops 300-600 m apart.
+    lat, lng, heading = 12.95, 77.55, 0.0
+    path = []
+    for i in range(stops):
+        path.append({'name': 'Stop %d' % i, 'lat': lat, 'lng': lng})
+        heading += rng.uniform(-0.6, 0.6)
+        step = rng.uniform(300, 600)
+        lat += step * math.cos(heading) / geometry.METERS_PER_DEGREE_LAT
+        lng += step * math.sin(heading) / geometry.METERS_PER_DEGREE_LNG
+    return geometry.RouteGeometry(1, 'BENCH', path)
+
+
+def noisy_fixes(rng, route, count, noise_m):
+    fixes = []
+    for _ in range(count):
+        i = rng.randrange(len(route.dxs))
+        t = rng.random()
+        lat = route.lats[i] + t * (route.lats[i + 1] - route.lats[i])
+        lng = route.lngs[i] + t * (route.lngs[i + 1] - route.lngs[i])
+        fixes.append((lat + rng.gauss(0, noise_m) / geometry.METERS_PER_DEGREE_LAT,
+                      lng + rng.gauss(0, noise_m) / geometry.METERS_PER_DEGREE_LNG))
+    return fixes
+
+
+def timed(fn, fixes):
+    start = time.perf_counter()
+    for lat, lng in fixes:
+        fn(lat, lng)
+    return (time.perf_counter() - start) / len(fixes) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stops', type=int, default=200)
+    parser.add_argument('--fixes', type=int, default=50000)
+    parser.add_argument('--noise', type=float, default=20.0, help='GPS noise, metres')
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    start = time.perf_counter()
+    route = make_route(rng, args.stops)
+    print('built route: %d segments, %d grid cells in %.1f ms' % (
+        len(route.dxs), len(route.cells), (time.perf_counter() - start) * 1000))
+    fixes = noisy_fixes(rng, route, args.fixes, args.noise)
+
+    def full_scan(lat, lng):
+        px, py = lng * route.scale, lat * geometry.METERS_PER_DEGREE_LAT
+        return route._nearest(px, py, range(len(route.dxs)))
+
+    scan = timed(full_scan, fixes)
+    grid = timed(route.snap, fixes)
+    print('full scan:     %8.2f us/fix' % scan)
+    print('segment grid:  %8.2f us/fix  (%.0fx)' % (grid, scan / grid))
+
+
+if __name__ == '__main__':
+    main()
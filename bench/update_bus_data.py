@@ -0,0 +1,66 @@
+"""Requests/sec for /update_bus_data with and without the connection pool.
+
+Run from the repository root:
+
+    python bench/update_bus_data.py --requests 5000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as smartbus  # noqa: E402
+import db  # noqa: E402
+import ingest  # noqa: E402
+import partitions  # noqa: E402
+
+
+def run(pool_size, requests, buses, mode='sync'):
+    with tempfile.TemporaryDirectory() as tmp:
+        db.pool = db.ConnectionPool(os.path.join(tmp, 'bench.db'), size=pool_size)
+        partitions.partitions.forget()
+        ingest.writer = ingest.IngestWriter(mode)
+        # Every ping should reach the database; this measures write throughput.
+        ingest.writer.suppressor = ingest.Suppressor(distance_m=0)
+        smartbus.init_db()
+        client = smartbus.app.test_client()
+
+        start = time.perf_counter()
+        for i in range(requests):
+            client.post('/update_bus_data', json={
+                'bus_no': 'KA-%04d' % (i % buses),
+                'latitude': 12.97 + i * 1e-6,
+                'longitude': 77.59 + i * 1e-6,
+                'air_quality': 40,
+                'passenger_count': 20,
+            })
+        ingest.writer.stop()
+        elapsed = time.perf_counter() - start
+        stats = db.pool.stats()
+        db.pool.close()
+    return requests / elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--buses', type=int, default=50)
+    parser.add_argument('--pool-size', type=int, default=db.POOL_SIZE)
+    args = parser.parse_args()
+
+    before, _ = run(0, args.requests, args.buses)
+    after, stats = run(args.pool_size, args.requests, args.buses)
+    print('per-request connect: %8.1f req/s' % before)
+    print('pooled (size=%d):    %8.1f req/s  (%.2fx)' % (args.pool_size, after, after / before))
+    print('pool stats: %s' % stats)
+
+    # Group commit only pays off with concurrent writers, so just async here.
+    write_behind, _ = run(args.pool_size, args.requests, args.buses, mode='async')
+    print('pooled + async:      %8.1f req/s  (%.2fx)' % (write_behind, write_behind / before))
+
+
+if __name__ == '__main__':
+    main()
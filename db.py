@@ -0,0 +1,175 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+import metrics
+
+DB_FILE = os.environ.get('SMARTBUS_DB', 'routes.db')
+POOL_SIZE = int(os.environ.get('SMARTBUS_DB_POOL', '4'))
+POOL_TIMEOUT = float(os.environ.get('SMARTBUS_DB_POOL_TIMEOUT', '10'))
+
+# Applied once per connection when the pool opens it, not per request.
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+)
+# Read-only connections cannot change the journal mode.
+READ_ONLY_PRAGMAS = PRAGMAS[2:] + ('PRAGMA query_only=1',)
+
+
+def cooperative():
+    """True in a gevent worker that has monkey-patched threading."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def blocking(fn, *args):
+    """fn(*args), on an OS thread from gevent's pool in a gevent worker.
+
+    A long SQLite call in a greenlet holds the hub: every other request and
+    the worker's heartbeat wait, and gunicorn kills the worker after its
+    timeout. The calling greenlet waits for the result without blocking.
+    """
+    if cooperative():
+        from gevent import get_hub
+        return get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+
+class ConnectionPool:
+    """Small LIFO pool of SQLite connections, one pool per worker process.
+
+    A size of 0 disables pooling: every acquire opens a fresh connection and
+    every release closes it, which is how app.py behaved before the pool.
+    A read_only pool opens the file with mode=ro and can never take the
+    write lock.
+    """
+
+    def __init__(self, db_file, size=POOL_SIZE, timeout=POOL_TIMEOUT, read_only=False):
+        self.db_file = db_file
+        self.size = size
+        self.timeout = timeout
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Connections must never cross a fork, so a gunicorn worker that
+        # inherits a pool from the master starts over with an empty one.
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _connect(self):
+        factory = metrics.TimedConnection if metrics.ENABLED else sqlite3.Connection
+        if self.read_only:
+            conn = sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(self.db_file)),
+                                   uri=True, timeout=self.timeout, check_same_thread=False,
+                                   factory=factory)
+        else:
+            conn = sqlite3.connect(self.db_file, timeout=self.timeout, check_same_thread=False,
+                                   factory=factory)
+        for pragma in READ_ONLY_PRAGMAS if self.read_only else PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+        if self.size <= 0:
+            with self._lock:
+                self.misses += 1
+            return self._connect()
+
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self.hits += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+                self.misses += 1
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError('timed out waiting for a pooled connection')
+        with self._lock:
+            self.waits += 1
+            self.wait_time += time.perf_counter() - start
+        return conn
+
+    def release(self, conn):
+        if self.size <= 0 or self._pid != os.getpid():
+            conn.close()
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pid': self._pid,
+                'read_only': self.read_only,
+                'size': self.size,
+                'open': self._created,
+                'idle': self._idle.qsize(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'wait_time_ms': round(self.wait_time * 1000, 3),
+            }
+
+
+pool = ConnectionPool(DB_FILE)
+
@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+import time
+
+import fleet
+import geometry
+import ingest
+import latest
+import storage
+
+log = logging.getLogger(__name__)
+
+# Every ETA request inside one tick shares the same fleet-wide computation.
+TICK = float(os.environ.get('SMARTBUS_ETA_TICK', '5'))
+DEFAULT_SPEED = 5.5       # m/s, about 20 km/h, until a bus has been observed
+MIN_SPEED = 1.0           # m/s floor so a stopped bus still gets a finite ETA
+MAX_SPEED = 35.0          # m/s; faster "movement" is GPS noise
+RECENT_WEIGHT = 0.6       # share of the bus's own recent speed in the blend
+SPEED_ALPHA = 0.3         # EWMA weight of each new observation
+RECENT_WINDOW = 300       # seconds of history used to seed a bus's speed
+# New buses seeded from history per tick; the rest wait for a later tick.
+SEED_PER_TICK = int(os.environ.get('SMARTBUS_ETA_SEED_PER_TICK', '50'))
+
+
+class Track:
+    __slots__ = ('route_no', 'along', 'at', 'segment', 'speed', 'seeded')
+
+    def __init__(self, route_no, along, at, segment, speed):
+        self.route_no = route_no
+        self.along = along
+        self.at = at
+        self.segment = segment
+        self.speed = speed
+        self.seeded = False
+
+
+def _ewma(old, new):
+    return new if old is None else old + SPEED_ALPHA * (new - old)
+
+
+class EtaEngine:
+    """Arrival estimates for every bus to each remaining stop on its route."""
+
+    def __init__(self, tick=TICK, seed_per_tick=SEED_PER_TICK):
+        self.tick = tick
+        self.seed_per_tick = seed_per_tick
+        self._lock = threading.Lock()
+        self._tracks = {}
+        # (route_no, segment index) -> observed m/s, learned across all buses.
+        self._segment_speeds = {}
+        self._result = None
+        self._computed_at = None
+        self.computations = 0
+        self.seeded = 0
+
+    def _seed_speed(self, bus_no, route, until):
+        start = ingest.utc_timestamp(until - RECENT_WINDOW)
+        points = list(storage.telemetry.fixes(bus_no, start, ingest.utc_timestamp(until)))
+        if len(points) < 2:
+            return None
+        (t0, lat0, lng0), (t1, lat1, lng1) = points[0], points[-1]
+        elapsed = ingest.to_epoch(t1) - ingest.to_epoch(t0)
+        if elapsed <= 0:
+            return None
+        speed = (route.project(lat1, lng1)[0] - route.project(lat0, lng0)[0]) / elapsed
+        return speed if 0 <= speed <= MAX_SPEED else None
+
+    def _observe(self, state, route, along, segment):
+        at = ingest.to_epoch(state.timestamp)
+        track = self._tracks.get(state.bus_no)
+        if track is None or track.route_no != route.route_no:
+            track = self._tracks[state.bus_no] = Track(route.route_no, along, at, segment, None)
+        elif at > track.at:
+            speed = (along - track.along) / (at - track.at)
+            if 0 <= speed <= MAX_SPEED:
+                track.speed = _ewma(track.speed, speed)
+                key = (route.route_no, segment)
+                self._segment_speeds[key] = _ewma(self._segment_speeds.get(key), speed)
+            track.along, track.at, track.segment = along, at, segment
+        return track
+
+    def _seed(self, unseeded):
+        # A few buses per tick, so one computation never reads the whole
+        # fleet's fixes; the rest are seeded on later ticks.
+        for bus_no, track, route in unseeded[:self.seed_per_tick]:
+            track.speed = self._seed_speed(bus_no, route, track.at)
+            track.seeded = True
+            self.seeded += 1
+
+    def _speed(self, track, route_no, segment):
+        historical = self._segment_speeds.get((route_no, segment))
+        recent = track.speed
+        if recent is None and historical is None:
+            speed = DEFAULT_SPEED
+        elif recent is None:
+            speed = historical
+        elif historical is None:
+            speed = recent
+        else:
+            speed = RECENT_WEIGHT * recent + (1 - RECENT_WEIGHT) * historical
+        return max(speed, MIN_SPEED)
+
+    def compute(self):
+        buses, stops = {}, {}
+        observed, unseeded = [], []
+        for state in latest.store.all():
+            route = geometry.routes.get(fleet.assignments.route_of(state.bus_no))
+            if route is None:
+                continue
+            along, offset, segment = route.project(state.latitude, state.longitude)
+            track = self._observe(state, route, along, segment)
+            observed.append((state, route, along, offset, segment, track))
+            # Only a bus with no speed of its own yet needs history.
+            if track.speed is None and not track.seeded:
+                unseeded.append((state.bus_no, track, route))
+        self._seed(unseeded)
+
+        for state, route, along, offset, segment, track in observed:
+            entry = buses[state.bus_no] = {
+                'bus_no': state.bus_no,
+                'route_no': route.route_no,
+                'progress_m': round(along, 1),
+                'off_route_m': round(offset, 1),
+                'speed_mps': None if track.speed is None else round(track.speed, 2),
+                'stops': [],
+            }
+            if offset > geometry.OFF_ROUTE_M:
+                continue
+
+            # Walk the remaining segments once, accumulating travel time.
+            cumulative = route.cumulative
+            elapsed = 0.0
+            for k in range(segment, len(cumulative) - 1):
+                remaining = cumulative[k + 1] - max(along, cumulative[k])
+                if remaining <= 0:
+                    continue
+                elapsed += remaining / self._speed(track, route.route_no, k)
+                name = route.names[k + 1]
+                eta_at = track.at + elapsed
+                distance = cumulative[k + 1] - along
+                entry['stops'].append({'name': name, 'distance_m': round(distance, 1),
+                                       'eta_at': eta_at})
+                stops.setdefault(name, []).append({
+                    'bus_no': state.bus_no, 'route_no': route.route_no,
+                    'distance_m': round(distance, 1), 'eta_at': eta_at})
+
+        for arrivals in stops.values():
+            arrivals.sort(key=lambda a: a['eta_at'])
+        self.computations += 1
+        return {'buses': buses, 'stops': stops}
+
+    def current(self):
+        fresh = self._computed_at is not None and time.monotonic() - self._computed_at < self.tick
+        if fresh:
+            return self._result
+        # One thread recomputes; the rest keep serving the previous tick.
+        if not self._lock.acquire(blocking=self._result is None):
+            return self._result
+        try:
+            if self._computed_at is None or time.monotonic() - self._computed_at >= self.tick:
+                self._result = self.compute()
+                self._computed_at = time.monotonic()
+        finally:
+            self._lock.release()
+        return self._result
+
+    def for_bus(self, bus_no):
+        entry = self.current()['buses'].get(bus_no)
+        if entry is None:
+            return None
+        now = time.time()
+        return dict(entry, stops=[_with_eta(s, now) for s in entry['stops']])
+
+    def for_stop(self, stop, route_no=None):
+        now = time.time()
+        return [_with_eta(a, now) for a in self.current()['stops'].get(stop, [])
+                if route_no is None or a['route_no'] == route_no]
+
+
+def _with_eta(item, now):
+    return dict(item, eta_s=max(0, round(item['eta_at'] - now)))
+
+
+engine = EtaEngine()
@@ -0,0 +1,262 @@
+"""Incremental columnar export of GPS history for analytics.
+
+Each run copies the fixes with ids past the last run's high-water mark into
+files laid out as
+
+    <EXPORT_DIR>/gps/date=YYYY-MM-DD/route=<route_no>/part-<first id>.<ext>
+    <EXPORT_DIR>/bus_status/date=YYYY-MM-DD/part-<first id>.<ext>
+
+Parquet when pyarrow is installed, CSV otherwise. Rows are read with
+fetchmany, so memory stays bounded however far behind the export is, and
+the high-water mark only moves once every file of a run is in place.
+Analysts query the export directory and never open the live database.
+
+Runs in the background from POST /export/run, or by hand with
+``python export.py``. Either way it reads from the replica.
+"""
+import csv
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import db
+import partitions
+import replica
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+log = logging.getLogger(__name__)
+
+EXPORT_DIR = os.environ.get('SMARTBUS_EXPORT_DIR', 'exports')
+FETCH_SIZE = 5000
+STATE_FILE = 'export_state.json'
+UNASSIGNED = '_unassigned'
+
+GPS_COLUMNS = (('id', int), ('bus_no', str), ('latitude', float), ('longitude', float),
+               ('timestamp', str), ('snapped_latitude', float), ('snapped_longitude', float),
+               ('progress', float), ('off_route', int), ('route_no', str))
+STATUS_COLUMNS = (('bus_no', str), ('latitude', float), ('longitude', float), ('timestamp', str),
+                  ('air_quality', int), ('passenger_count', int), ('last_seen', str),
+                  ('exported_through_id', int))
+
+
+class CsvPart:
+    extension = 'csv'
+
+    def __init__(self, path, columns):
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([name for name, _ in columns])
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetPart:
+    extension = 'parquet'
+
+    def __init__(self, path, columns):
+        types = {int: pyarrow.int64(), float: pyarrow.float64(), str: pyarrow.string()}
+        self.schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        # Each chunk becomes one row group.
+        self._writer.write_table(pyarrow.Table.from_pydict(
+            {name: [row[i] for row in rows] for i, name in enumerate(self.schema.names)},
+            schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+
+
+Part = ParquetPart if pyarrow is not None else CsvPart
+
+
+class Exporter:
+    """Writes one partition file per (date, route) for every run."""
+
+    def __init__(self, directory=EXPORT_DIR):
+        self.directory = directory
+        self.last_run = None
+        self.last_error = None
+        # The lease stops other workers; this stops a second run in this one.
+        self._running = threading.Lock()
+
+    @property
+    def holder(self):
+        return '%s:%d' % (socket.gethostname(), os.getpid())
+
+    def state(self):
+        try:
+            with open(os.path.join(self.directory, STATE_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'last_id': 0, 'runs': 0, 'format': Part.extension}
+
+    def _save_state(self, state):
+        path = os.path.join(self.directory, STATE_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def _open(self, parts, key, subdir, columns, first_id):
+        part = parts.get(key)
+        if part is None:
+            directory = os.path.join(self.directory, *subdir)
+            os.makedirs(directory, exist_ok=True)
+            # A run that died half way is redone under the same names.
+            path = os.path.join(directory, 'part-%012d.%s' % (first_id, Part.extension))
+            part = parts[key] = (Part(path + '.tmp', columns), path)
+        return part[0]
+
+    def _claim(self):
+        if not self._running.acquire(blocking=False):
+            return False
+        try:
+            with db.pool.connection() as conn:
+                if partitions.claim_lease(conn, 'exporter', self.holder, 3600):
+                    return True
+        except Exception:
+            self._running.release()
+            raise
+        self._running.release()
+        return False
+
+    def _release(self):
+        try:
+            with db.pool.connection() as conn:
+                conn.execute("UPDATE maintenance_leases SET expires = 0 WHERE name = 'exporter' AND holder = ?",
+                             (self.holder,))
+                conn.commit()
+        finally:
+            self._running.release()
+
+    def _export(self):
+        # Reads come from the replica; the copy itself runs off the hub.
+        with replica.replica.connection() as conn:
+            return db.blocking(self._run, conn)
+
+    def run(self):
+        """Export everything past the high-water mark; returns a summary, or
+        None when another worker holds the export lease."""
+        if not self._claim():
+            return None
+        try:
+            return self._export()
+        finally:
+            self._release()
+
+    def start(self):
+        """Start a run in the background; False when one is already running."""
+        if not self._claim():
+            return False
+        self.last_error = None
+        threading.Thread(target=self._background, name='export', daemon=True).start()
+        return True
+
+    def _background(self):
+        try:
+            self.last_run = self._export()
+        except Exception as e:
+            log.exception('export failed')
+            self.last_error = str(e)
+        finally:
+            self._release()
+
+    def status(self):
+        with db.pool.connection() as conn:
+            row = conn.execute("SELECT holder, expires FROM maintenance_leases WHERE name = 'exporter'").fetchone()
+        running = row is not None and row[1] > time.time()
+        return dict(self.state(), running=running, holder=row[0] if running else None,
+                    last_run=self.last_run, last_error=self.last_error)
+
+    def _run(self, conn):
+        state = self.state()
+        after = state['last_id']
+        through = conn.execute('SELECT last_id FROM gps_sequence').fetchone()[0]
+        summary = {'after_id': after, 'through_id': through, 'rows': 0, 'files': 0,
+                   'format': Part.extension}
+        if through <= after:
+            return summary
+
+        route_of = dict(conn.execute('SELECT bus_no, route_no FROM buses'))
+        parts = {}
+        try:
+            for rows in chunks_after(conn, after, through):
+                groups = {}
+                for row in rows:
+                    route_no = route_of.get(row[1], UNASSIGNED)
+                    groups.setdefault((row[4][:10], route_no), []).append(row + (route_no,))
+                for (day, route_no), group in groups.items():
+                    self._open(parts, (day, route_no),
+                               ('gps', 'date=' + day, 'route=' + route_no.replace('/', '_')),
+                               GPS_COLUMNS, after + 1).write(group)
+                summary['rows'] += len(rows)
+
+            today = time.strftime('%Y-%m-%d', time.gmtime())
+            status = self._open(parts, 'bus_status', ('bus_status', 'date=' + today),
+                                STATUS_COLUMNS, after + 1)
+            cur = conn.execute('''
+                SELECT bus_no, latitude, longitude, timestamp, air_quality, passenger_count,
+                       last_seen, ?
+                FROM bus_latest ORDER BY bus_no
+            ''', (through,))
+            while True:
+                rows = cur.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                status.write(rows)
+        except Exception:
+            for part, path in parts.values():
+                part.close()
+                os.remove(path + '.tmp')
+            raise
+
+        for part, path in parts.values():
+            part.close()
+            os.replace(path + '.tmp', path)
+        summary['files'] = len(parts)
+        state.update(last_id=through, runs=state['runs'] + 1, format=Part.extension)
+        self._save_state(state)
+        log.info('export: %s', summary)
+        return summary
+
+
+def chunks_after(conn, after, through):
+    """Yield lists of history rows with after < id <= through."""
+    for day in partitions.days(conn):
+        cur = conn.execute('SELECT %s FROM %s WHERE id > ? AND id <= ? ORDER BY id' % (
+            partitions.COLUMN_NAMES, partitions.table_name(day)), (after, through))
+        while True:
+            rows = cur.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            yield rows
+
+
+def stream_csv(after, through):
+    """Chunks of CSV for rows after `after`; holds a read connection while it runs."""
+    with replica.replica.connection() as conn:
+        yield ','.join(partitions.COLUMN_NAMES.split(', ')) + '\n'
+        for rows in chunks_after(conn, after, through):
+            yield ''.join(','.join('' if v is None else str(v) for v in row) + '\n'
+                          for row in rows)
+
+
+exporter = Exporter()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print(exporter.run())
@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+import zlib
+
+import storage
+from latest import BusState
+
+COLUMNS = BusState.__slots__
+
+# add_bus/delete_bus in another worker show up here after at most this long.
+ASSIGNMENT_TTL = float(os.environ.get('SMARTBUS_ASSIGNMENT_TTL', '5'))
+
+
+class Assignments:
+    """Cached bus_no -> route_no map from the buses table."""
+
+    def __init__(self, ttl=ASSIGNMENT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._route_of = {}
+        self._buses_on = {}
+        self._loaded_at = None
+
+    def load(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        rows = [(bus_no, route_no) for _, bus_no, route_no in storage.buses.all()]
+        buses_on = {}
+        for bus_no, route_no in rows:
+            buses_on.setdefault(route_no, []).append(bus_no)
+        with self._lock:
+            self._route_of = dict(rows)
+            self._buses_on = {route_no: sorted(b) for route_no, b in buses_on.items()}
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def route_of(self, bus_no, load=True):
+        # load=False never touches the database, for callers holding other locks.
+        if load:
+            self.load()
+        return self._route_of.get(bus_no)
+
+    def buses_on(self, route_no):
+        self.load()
+        return self._buses_on.get(route_no, [])
+
+
+assignments = Assignments()
+
+
+def parse_bbox(value):
+    # Leaflet's toBBoxString() order: west,south,east,north.
+    if not value:
+        return None
+    west, south, east, north = (float(v) for v in value.split(','))
+    return west, south, east, north
+
+
+def select(states, bus_nos=None, bbox=None):
+    if bus_nos is not None:
+        wanted = set(bus_nos)
+        states = [s for s in states if s.bus_no in wanted]
+    if bbox is not None:
+        west, south, east, north = bbox
+        states = [s for s in states
+                  if south <= s.latitude <= north and west <= s.longitude <= east]
+    return states
+
+
+def encode(states, columnar=False):
+    if columnar:
+        # Parallel arrays: field names once instead of once per bus.
+        return {name: [getattr(s, name) for s in states] for name in COLUMNS}
+    return {'buses': [s.as_dict() for s in states]}
+
+
+def etag(version, *key):
+    # Versions are per worker, so the pid keeps two workers from sharing a tag.
+    return '%d-%d-%08x' % (os.getpid(), version, zlib.crc32(repr(key).encode()))
@@ -0,0 +1,207 @@
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from array import array
+
+import storage
+
+log = logging.getLogger(__name__)
+
+# add_route in another worker shows up here after at most this long.
+ROUTE_CACHE_TTL = float(os.environ.get('SMARTBUS_ROUTE_CACHE_TTL', '30'))
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE_LAT = 110574.0
+METERS_PER_DEGREE_LNG = 111320.0
+# Fixes further than this from their route count as off route.
+OFF_ROUTE_M = float(os.environ.get('SMARTBUS_OFF_ROUTE_M', '150'))
+# Edge of the per-route segment grid, in metres.
+SEGMENT_CELL_M = 250.0
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+class RouteGeometry:
+    """A route's stops parsed once into flat coordinate arrays."""
+
+    __slots__ = ('id', 'route_no', 'names', 'lats', 'lngs', 'cumulative', 'bbox',
+                 'scale', 'xs', 'ys', 'dxs', 'dys', 'inv_length2', 'cells')
+
+    def __init__(self, id, route_no, stops):
+        self.id = id
+        self.route_no = route_no
+        self.names = [s['name'] for s in stops]
+        self.lats = array('d', (float(s['lat']) for s in stops))
+        self.lngs = array('d', (float(s['lng']) for s in stops))
+        # Distance in metres from the first stop to each stop along the path.
+        self.cumulative = array('d', [0.0])
+        for i in range(1, len(stops)):
+            self.cumulative.append(self.cumulative[-1] + haversine(
+                self.lats[i - 1], self.lngs[i - 1], self.lats[i], self.lngs[i]))
+        # south, west, north, east
+        self.bbox = (min(self.lats), min(self.lngs), max(self.lats), max(self.lngs))
+        # Stops in a local planar frame (metres) for fast projection.
+        self.scale = math.cos(math.radians((self.bbox[0] + self.bbox[2]) / 2)) * METERS_PER_DEGREE_LNG
+        self.xs = array('d', (lng * self.scale for lng in self.lngs))
+        self.ys = array('d', (lat * METERS_PER_DEGREE_LAT for lat in self.lats))
+        # Per-segment vectors, so projecting a fix does no setup work.
+        n = len(stops) - 1
+        self.dxs = array('d', (self.xs[i + 1] - self.xs[i] for i in range(n)))
+        self.dys = array('d', (self.ys[i + 1] - self.ys[i] for i in range(n)))
+        self.inv_length2 = array('d', (
+            0.0 if dx == 0 and dy == 0 else 1.0 / (dx * dx + dy * dy)
+            for dx, dy in zip(self.dxs, self.dys)))
+        self.cells = self._segment_cells()
+
+    def _segment_cells(self):
+        # Each grid cell lists the segments passing within OFF_ROUTE_M of it,
+        # so an on-route fix only checks the few segments around it.
+        cells = {}
+        for i in range(len(self.dxs)):
+            x0, x1 = sorted((self.xs[i], self.xs[i + 1]))
+            y0, y1 = sorted((self.ys[i], self.ys[i + 1]))
+            for cx in range(int(math.floor((x0 - OFF_ROUTE_M) / SEGMENT_CELL_M)),
+                            int(math.floor((x1 + OFF_ROUTE_M) / SEGMENT_CELL_M)) + 1):
+                for cy in range(int(math.floor((y0 - OFF_ROUTE_M) / SEGMENT_CELL_M)),
+                                int(math.floor((y1 + OFF_ROUTE_M) / SEGMENT_CELL_M)) + 1):
+                    cells.setdefault((cx, cy), []).append(i)
+        return {cell: tuple(segments) for cell, segments in cells.items()}
+
+    @classmethod
+    def from_path(cls, id, route_no, path):
+        stops = json.loads(path)
+        if not isinstance(stops, list) or not stops:
+            raise ValueError('path must be a non-empty list of stops')
+        return cls(id, route_no, stops)
+
+    @property
+    def length(self):
+        return self.cumulative[-1]
+
+    def _nearest(self, px, py, segments):
+        # (squared offset, segment index, t along it) of the closest segment.
+        xs, ys, dxs, dys, inv = self.xs, self.ys, self.dxs, self.dys, self.inv_length2
+        best, best_i, best_t = math.inf, 0, 0.0
+        for i in segments:
+            ax, ay, dx, dy = xs[i], ys[i], dxs[i], dys[i]
+            t = ((px - ax) * dx + (py - ay) * dy) * inv[i]
+            t = 0.0 if t < 0.0 else 1.0 if t > 1.0 else t
+            ox, oy = px - ax - t * dx, py - ay - t * dy
+            d2 = ox * ox + oy * oy
+            if d2 < best:
+                best, best_i, best_t = d2, i, t
+        return best, best_i, best_t
+
+    def locate(self, lat, lng):
+        """Nearest point on the route as (segment index, t in [0, 1], offset in metres)."""
+        px, py = lng * self.scale, lat * METERS_PER_DEGREE_LAT
+        if not self.dxs:
+            return 0, 0.0, math.hypot(px - self.xs[0], py - self.ys[0])
+        candidates = self.cells.get((int(math.floor(px / SEGMENT_CELL_M)),
+                                     int(math.floor(py / SEGMENT_CELL_M))))
+        if candidates:
+            d2, i, t = self._nearest(px, py, candidates)
+            if d2 <= OFF_ROUTE_M * OFF_ROUTE_M:
+                return i, t, math.sqrt(d2)
+        # Off route: only a full scan is sure to find the nearest segment.
+        d2, i, t = self._nearest(px, py, range(len(self.dxs)))
+        return i, t, math.sqrt(d2)
+
+    def project(self, lat, lng):
+        """Nearest point on the route to (lat, lng).
+
+        Returns (distance along the route in metres, distance off the route in
+        metres, index of the segment it falls on).
+        """
+        i, t, offset = self.locate(lat, lng)
+        if not self.dxs:
+            return 0.0, offset, 0
+        cumulative = self.cumulative
+        return cumulative[i] + t * (cumulative[i + 1] - cumulative[i]), offset, i
+
+    def snap(self, lat, lng):
+        """(snapped lat, snapped lng, distance along in metres, offset in metres)."""
+        i, t, offset = self.locate(lat, lng)
+        if not self.dxs:
+            return self.lats[0], self.lngs[0], 0.0, offset
+        cumulative = self.cumulative
+        return (self.lats[i] + t * (self.lats[i + 1] - self.lats[i]),
+                self.lngs[i] + t * (self.lngs[i + 1] - self.lngs[i]),
+                cumulative[i] + t * (cumulative[i + 1] - cumulative[i]),
+                offset)
+
+    def point_at(self, along):
+        """(lat, lng, heading in degrees from north) at a distance along the route."""
+        if not self.dxs:
+            return self.lats[0], self.lngs[0], None
+        along = max(0.0, min(along, self.length))
+        cumulative = self.cumulative
+        i = min(max(bisect.bisect_right(cumulative, along) - 1, 0), len(self.dxs) - 1)
+        span = cumulative[i + 1] - cumulative[i]
+        t = 0.0 if span == 0 else (along - cumulative[i]) / span
+        heading = math.degrees(math.atan2(self.dxs[i], self.dys[i])) % 360
+        return (self.lats[i] + t * (self.lats[i + 1] - self.lats[i]),
+                self.lngs[i] + t * (self.lngs[i + 1] - self.lngs[i]),
+                heading)
+
+    def stops(self):
+        return [{'name': n, 'lat': lat, 'lng': lng}
+                for n, lat, lng in zip(self.names, self.lats, self.lngs)]
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'route_no': self.route_no,
+            'stops': self.stops(),
+            'length_m': round(self.length, 1),
+            'bbox': self.bbox,
+        }
+
+
+class RouteCache:
+    """route_no -> RouteGeometry for every route with a usable path."""
+
+    def __init__(self, ttl=ROUTE_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._loaded_at = None
+        self.version = 0
+
+    def load(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        routes = {}
+        for id, route_no, path in storage.routes.all():
+            try:
+                routes[route_no] = RouteGeometry.from_path(id, route_no, path)
+            except (ValueError, KeyError, TypeError):
+                log.warning('route %s has an unusable path; skipped', route_no)
+        with self._lock:
+            if routes.keys() != self._routes.keys() or any(
+                    routes[r].id != self._routes[r].id for r in routes):
+                self.version += 1
+            self._routes = routes
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def get(self, route_no):
+        self.load()
+        return self._routes.get(route_no)
+
+    def all(self):
+        self.load()
+        return sorted(self._routes.values(), key=lambda g: g.id)
+
+
+routes = RouteCache()
@@ -0,0 +1,34 @@
+import glob
+import os
+
+# The master never imports the app. Its module-level locks, queues and
+# thread-locals would be created before gevent workers patch threading, and
+# the workers would inherit real OS locks that block the hub.
+
+
+def on_starting(server):
+    # Samples left by a previous run's workers would be summed into this one.
+    # Same default as metrics.DIRECTORY, without importing metrics here.
+    directory = os.environ.get('SMARTBUS_METRICS_DIR', 'metrics')
+    for path in glob.glob(os.path.join(directory, '*.metrics')):
+        os.remove(path)
+
+
+def post_worker_init(worker):
+    # Upgrade the schema before this worker serves. The file lock lets the first
+    # worker migrate while the rest wait, then find nothing left to do.
+    import fcntl
+    import app
+    import db
+    with open(db.pool.db_file + '.migrate-lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            app.init_db()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def worker_exit(server, worker):
+    # Flush pings still sitting in the write-behind queue before the worker goes away.
+    import ingest
+    ingest.writer.stop()
@@ -0,0 +1,96 @@
+import json
+import math
+import os
+
+import storage
+from geometry import METERS_PER_DEGREE_LAT, METERS_PER_DEGREE_LNG
+
+# Douglas-Peucker runs over windows of this many fixes so memory stays flat
+# however long the requested range is; window edges are always kept.
+SIMPLIFY_WINDOW = int(os.environ.get('SMARTBUS_HISTORY_SIMPLIFY_WINDOW', '2048'))
+LINES_PER_CHUNK = 500
+
+
+def _segment_distance(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    if dx == 0 and dy == 0:
+        return math.hypot(px - ax, py - ay)
+    t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+def douglas_peucker(points, tolerance):
+    """Return the fixes of `points` kept at `tolerance` metres."""
+    if len(points) < 3:
+        return list(points)
+    # Local equirectangular projection to metres, good enough within a window.
+    scale = math.cos(math.radians(points[0][1])) * METERS_PER_DEGREE_LNG
+    xy = [(p[2] * scale, p[1] * METERS_PER_DEGREE_LAT) for p in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = xy[first]
+        bx, by = xy[last]
+        worst, worst_index = 0.0, None
+        for i in range(first + 1, last):
+            d = _segment_distance(xy[i][0], xy[i][1], ax, ay, bx, by)
+            if d > worst:
+                worst, worst_index = d, i
+        if worst_index is not None and worst > tolerance:
+            keep[worst_index] = True
+            stack.append((first, worst_index))
+            stack.append((worst_index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def simplify(stream, tolerance, window=SIMPLIFY_WINDOW):
+    window_points = []
+    for fix in stream:
+        window_points.append(fix)
+        if len(window_points) >= window:
+            kept = douglas_peucker(window_points, tolerance)
+            yield from kept[:-1]
+            # The last kept fix starts the next window so the track stays joined.
+            window_points = [window_points[-1]]
+    if window_points:
+        yield from douglas_peucker(window_points, tolerance)
+
+
+def _ndjson(stream):
+    for ts, lat, lng in stream:
+        yield '%s\n' % json.dumps({'timestamp': ts, 'latitude': lat, 'longitude': lng})
+
+
+def _csv(stream):
+    yield 'timestamp,latitude,longitude\n'
+    for ts, lat, lng in stream:
+        yield '%s,%r,%r\n' % (ts, lat, lng)
+
+
+FORMATS = {
+    'ndjson': ('application/x-ndjson', _ndjson),
+    'csv': ('text/csv', _csv),
+}
+
+
+def stream(bus_no, start, end, tolerance=None, fmt='ndjson'):
+    """Generator of response chunks; holds a pooled connection while it runs."""
+    encode = FORMATS[fmt][1]
+    fixes = storage.telemetry.fixes(bus_no, start, end)
+    try:
+        points = simplify(fixes, tolerance) if tolerance else fixes
+        chunk = []
+        for line in encode(points):
+            chunk.append(line)
+            if len(chunk) >= LINES_PER_CHUNK:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+    finally:
+        # A client that disconnects early leaves fixes() suspended; this
+        # hands its connection back now rather than at garbage collection.
+        fixes.close()
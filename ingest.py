@@ -0,0 +1,412 @@
+import atexit
+import collections
+import datetime
+import logging
+import math
+import os
+import queue
+import threading
+import time
+
+import db
+import fleet
+import geometry
+import metrics
+import partitions
+import storage
+
+log = logging.getLogger(__name__)
+
+# sync:  write and commit inside the request, one transaction per ping.
+# group: queue the ping and block until the batch holding it is committed.
+# async: queue the ping and acknowledge immediately; the writer flushes every
+#        FLUSH_INTERVAL_MS or FLUSH_ROWS pings, whichever comes first.
+MODES = ('sync', 'group', 'async')
+MODE = os.environ.get('SMARTBUS_INGEST_MODE', 'group')
+FLUSH_INTERVAL_MS = int(os.environ.get('SMARTBUS_INGEST_FLUSH_MS', '50'))
+FLUSH_ROWS = int(os.environ.get('SMARTBUS_INGEST_FLUSH_ROWS', '500'))
+QUEUE_SIZE = int(os.environ.get('SMARTBUS_INGEST_QUEUE', '10000'))
+ENQUEUE_TIMEOUT = float(os.environ.get('SMARTBUS_INGEST_ENQUEUE_TIMEOUT', '0.5'))
+BATCH_LIMIT = int(os.environ.get('SMARTBUS_INGEST_BATCH_LIMIT', '5000'))
+# Under gevent every SQLite call blocks the hub, so a group-commit writer
+# that drains straight away only finds the ping that woke it. It waits this
+# long first, letting requests that are ready to run queue their pings.
+GEVENT_LINGER_MS = float(os.environ.get('SMARTBUS_INGEST_GEVENT_LINGER_MS', '2'))
+# Device clocks further ahead of ours than this are rejected.
+MAX_CLOCK_SKEW = 300
+# Snap each fix to its bus's route before it is stored.
+SNAP = os.environ.get('SMARTBUS_INGEST_SNAP', '0') == '1'
+# A fix within this many metres of the bus's last stored fix, with the same
+# status, only refreshes bus_latest.last_seen; 0 stores every fix.
+STATIONARY_M = float(os.environ.get('SMARTBUS_INGEST_STATIONARY_M', '10'))
+# A parked bus still gets one history row this often.
+STATIONARY_MAX_S = float(os.environ.get('SMARTBUS_INGEST_STATIONARY_MAX_S', '300'))
+
+# snap is (snapped_latitude, snapped_longitude, progress, off_route) once the
+# snap stage has run.
+Ping = collections.namedtuple(
+    'Ping', 'bus_no latitude longitude air_quality passenger_count timestamp snap',
+    defaults=(None,))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class WriteFailed(Exception):
+    pass
+
+
+def utc_timestamp(t=None):
+    # CURRENT_TIMESTAMP's format plus milliseconds, which SQLite's date
+    # functions accept and which still sorts correctly as text.
+    if t is None:
+        t = time.time()
+    try:
+        return '%s.%03d' % (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t)), int(t * 1000) % 1000)
+    except (OverflowError, OSError, ValueError):
+        # gmtime() can't represent years far outside the calendar.
+        raise ValueError('timestamp is out of range')
+
+
+def to_epoch(value):
+    # Unix seconds, or ISO 8601 text; naive text is taken to be UTC.
+    try:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            t = float(value)
+        elif isinstance(value, str):
+            try:
+                t = float(value)
+            except ValueError:
+                parsed = datetime.datetime.fromisoformat(value)
+                if parsed.tzinfo is None:
+                    parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+                t = parsed.timestamp()
+        else:
+            t = None
+    except (OverflowError, OSError, ValueError):
+        t = None
+    if t is None or not math.isfinite(t):
+        raise ValueError('timestamp must be unix seconds or ISO 8601')
+    return t
+
+
+def parse_timestamp(value, now):
+    t = to_epoch(value)
+    if t > now + MAX_CLOCK_SKEW:
+        raise ValueError('timestamp is in the future')
+    timestamp = utc_timestamp(t)
+    if timestamp[:10] < partitions.retention_cutoff(now):
+        raise ValueError('timestamp is older than history retention')
+    return timestamp
+
+
+def parse_bus_no(value):
+    # SQLite's TEXT affinity used to turn a numeric bus_no into text; the
+    # in-memory stores key on it, so do the same before they see it.
+    if isinstance(value, bool) or not isinstance(value, (str, int)) or value == '':
+        raise ValueError('missing bus_no')
+    return str(value)
+
+
+def parse_status(value, name):
+    """A sensor reading as a non-negative int, or None when it is absent."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError('%s must be a non-negative integer' % name)
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError('%s must be a non-negative integer' % name)
+    if (not isinstance(value, (int, float)) or not math.isfinite(value) or value < 0
+            or value != int(value)):
+        raise ValueError('%s must be a non-negative integer' % name)
+    return int(value)
+
+
+def parse_fix(record, now, received):
+    if not isinstance(record, dict):
+        raise ValueError('fix must be an object')
+    bus_no = parse_bus_no(record.get('bus_no'))
+    try:
+        latitude = float(record['latitude'])
+        longitude = float(record['longitude'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('missing or invalid coordinates')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('coordinates out of range')
+    timestamp = record.get('timestamp')
+    timestamp = received if timestamp is None else parse_timestamp(timestamp, now)
+    return Ping(bus_no, latitude, longitude,
+                parse_status(record.get('air_quality'), 'air_quality'),
+                parse_status(record.get('passenger_count'), 'passenger_count'), timestamp)
+
+
+def snap(pings):
+    # Runs before a connection is taken: the caches may need to load.
+    snapped = []
+    for p in pings:
+        route = geometry.routes.get(fleet.assignments.route_of(p.bus_no))
+        if route is None:
+            snapped.append(p)
+            continue
+        lat, lng, progress, offset = route.snap(p.latitude, p.longitude)
+        snapped.append(p._replace(snap=(lat, lng, progress, int(offset > geometry.OFF_ROUTE_M))))
+    return snapped
+
+
+class Suppressor:
+    """Drops history rows for buses that have not moved or changed status.
+
+    State is per worker, so a bus whose pings spread over several workers is
+    suppressed less, never wrongly.
+    """
+
+    def __init__(self, distance_m=STATIONARY_M, max_interval=STATIONARY_MAX_S):
+        self.distance_m = distance_m
+        self.max_interval = max_interval
+        self._lock = threading.Lock()
+        self._stored = {}
+        self.stored = 0
+        self.suppressed = 0
+
+    def split(self, pings):
+        """(pings to store, pings that only refresh the heartbeat)."""
+        if self.distance_m <= 0:
+            return pings, []
+        stored, heartbeats, batch = [], [], {}
+        for p in pings:
+            previous = batch.get(p.bus_no) or self._stored.get(p.bus_no)
+            if (previous is not None and p.timestamp >= previous.timestamp
+                    and (p.air_quality, p.passenger_count)
+                    == (previous.air_quality, previous.passenger_count)
+                    and to_epoch(p.timestamp) - to_epoch(previous.timestamp) < self.max_interval
+                    and geometry.haversine(previous.latitude, previous.longitude,
+                                           p.latitude, p.longitude) < self.distance_m):
+                heartbeats.append(p)
+                continue
+            stored.append(p)
+            if previous is None or p.timestamp >= previous.timestamp:
+                batch[p.bus_no] = p
+        return stored, heartbeats
+
+    def committed(self, stored, heartbeats):
+        with self._lock:
+            for p in stored:
+                previous = self._stored.get(p.bus_no)
+                if previous is None or p.timestamp >= previous.timestamp:
+                    self._stored[p.bus_no] = p
+            self.stored += len(stored)
+            self.suppressed += len(heartbeats)
+
+
+def write_batch(pings, suppressor=None):
+    heartbeats = []
+    if suppressor is not None:
+        pings, heartbeats = suppressor.split(pings)
+    storage.telemetry.write(pings, heartbeats)
+    if suppressor is not None:
+        suppressor.committed(pings, heartbeats)
+
+
+class IngestWriter:
+    """Write-behind queue that flushes pings in one transaction per batch."""
+
+    def __init__(self, mode=MODE, flush_interval_ms=FLUSH_INTERVAL_MS,
+                 flush_rows=FLUSH_ROWS, queue_size=QUEUE_SIZE, snap=SNAP):
+        if mode not in MODES:
+            raise ValueError('unknown ingest mode %r' % mode)
+        self.mode = mode
+        self.snap = snap
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.flush_rows = flush_rows
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._thread = None
+        self._stopping = False
+        self._enqueue_lock = threading.Lock()
+        self._committed = threading.Condition()
+        self._submitted_seq = 0
+        self._committed_seq = 0
+        self._failed = collections.deque(maxlen=64)
+        self.batches = 0
+        self.rows = 0
+        self.max_batch = 0
+        self.rejected = 0
+        self.errors = 0
+        self.snapped = 0
+        self.off_route = 0
+        self.suppressor = Suppressor()
+        self.linger = GEVENT_LINGER_MS / 1000.0 if db.cooperative() else 0.0
+
+    def _ensure_started(self):
+        # Threads do not survive fork, so each gunicorn worker starts its own.
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='ingest-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, ping):
+        self.submit_many([ping])
+
+    def submit_many(self, pings):
+        if self.snap:
+            pings = snap(pings)
+            snapped = [p.snap for p in pings if p.snap is not None]
+            with self._lock:
+                self.snapped += len(snapped)
+                self.off_route += sum(s[3] for s in snapped)
+        if self.mode == 'sync':
+            start = time.perf_counter()
+            write_batch(pings, self.suppressor)
+            metrics.record_ingest_batch(len(pings), time.perf_counter() - start, 0)
+            with self._lock:
+                self.batches += 1
+                self.rows += len(pings)
+            return
+
+        self._ensure_started()
+        # Sequence numbers must enter the queue in order for group commit.
+        with self._enqueue_lock:
+            if not self._wait_for_room(len(pings)):
+                with self._lock:
+                    self.rejected += len(pings)
+                raise QueueFull('ingest queue is full')
+            first = self._submitted_seq + 1
+            for ping in pings:
+                self._submitted_seq += 1
+                self._queue.put((self._submitted_seq, ping))
+            last = self._submitted_seq
+        metrics.set_queue_depth(self._queue.qsize())
+
+        if self.mode == 'group':
+            self._wait_committed(first, last)
+
+    def _wait_for_room(self, needed):
+        # Give the writer up to ENQUEUE_TIMEOUT to make room before refusing.
+        if needed > self.queue_size:
+            return False
+        deadline = time.monotonic() + ENQUEUE_TIMEOUT
+        while self.queue_size - self._queue.qsize() < needed:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def _wait_committed(self, first, last):
+        with self._committed:
+            while self._committed_seq < last:
+                self._committed.wait()
+        for low, high in self._failed:
+            if low <= last and first <= high:
+                raise WriteFailed('batch containing these pings failed to commit')
+
+    def _collect(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        if self.mode == 'group':
+            # Commit whatever piled up while the last batch was being written;
+            # waiters are blocked, so there is no point holding the batch open
+            # longer than a cooperative scheduler needs to hand over.
+            if self.linger:
+                time.sleep(self.linger)
+            return batch + self._drain(self.flush_rows - 1)
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self, limit=None):
+        limit = self.flush_rows if limit is None else limit
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        seqs = [seq for seq, _ in batch]
+        try:
+            start = time.perf_counter()
+            write_batch([ping for _, ping in batch], self.suppressor)
+            metrics.record_ingest_batch(len(batch), time.perf_counter() - start, self._queue.qsize())
+            with self._lock:
+                self.batches += 1
+                self.rows += len(batch)
+                self.max_batch = max(self.max_batch, len(batch))
+        except Exception:
+            log.exception('ingest batch of %d pings failed', len(batch))
+            with self._lock:
+                self.errors += 1
+            self._failed.append((min(seqs), max(seqs)))
+        with self._committed:
+            self._committed_seq = max(self._committed_seq, max(seqs))
+            self._committed.notify_all()
+
+    def _run(self):
+        while not self._stopping:
+            batch = self._collect()
+            if batch:
+                self._write(batch)
+
+    def flush(self):
+        # Used on shutdown, after the writer thread has stopped.
+        while True:
+            batch = self._drain()
+            if not batch:
+                break
+            self._write(batch)
+
+    def stop(self, timeout=5.0):
+        if self._pid != os.getpid():
+            return
+        self._stopping = True
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'queued': self._queue.qsize(),
+                'queue_size': self.queue_size,
+                'linger_ms': self.linger * 1000,
+                'batches': self.batches,
+                'rows': self.rows,
+                'max_batch': self.max_batch,
+                'rejected': self.rejected,
+                'errors': self.errors,
+                'snap': self.snap,
+                'snapped': self.snapped,
+                'off_route': self.off_route,
+                'stored': self.suppressor.stored,
+                'suppressed': self.suppressor.suppressed,
+            }
+
+
+writer = IngestWriter()
+atexit.register(writer.stop)
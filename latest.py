@@ -0,0 +1,150 @@
+import collections
+import os
+import threading
+import time
+
+import storage
+
+# How stale another worker's pings may be before a read tails gps_data for them.
+REFRESH_MS = int(os.environ.get('SMARTBUS_LATEST_REFRESH_MS', '500'))
+# Fixes kept per bus for dead reckoning.
+RECENT_FIXES = 3
+
+
+class BusState:
+    __slots__ = ('bus_no', 'latitude', 'longitude', 'timestamp', 'air_quality', 'passenger_count')
+
+    def __init__(self, bus_no, latitude, longitude, timestamp, air_quality, passenger_count):
+        self.bus_no = bus_no
+        self.latitude = latitude
+        self.longitude = longitude
+        self.timestamp = timestamp
+        self.air_quality = air_quality
+        self.passenger_count = passenger_count
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class LatestStore:
+    """Latest known position and status per bus, kept in memory.
+
+    Each worker warms from the bus_latest table. Pings handled by this worker
+    are written through immediately. Pings that landed in other gunicorn
+    workers are picked up by tailing gps_data past the highest id seen, so
+    reads never scan the table's history.
+    """
+
+    def __init__(self, refresh_ms=REFRESH_MS):
+        self.refresh_interval = refresh_ms / 1000.0
+        self._buses = {}
+        self._recent = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._pid = None
+        self._listeners = []
+        self.version = 0
+        self._last_id = 0
+        self._refreshed_at = 0.0
+
+    def _apply(self, bus_no, latitude, longitude, timestamp, air_quality, passenger_count,
+               notify=True, tailing=False):
+        state = self._buses.get(bus_no)
+        if state is None:
+            state = self._buses[bus_no] = BusState(
+                bus_no, latitude, longitude, timestamp, air_quality, passenger_count)
+            self._recent[bus_no] = collections.deque(
+                [(timestamp, latitude, longitude)], maxlen=RECENT_FIXES)
+            changed = True
+        elif timestamp > state.timestamp or (timestamp == state.timestamp and not tailing):
+            recent = self._recent[bus_no]
+            if timestamp == recent[-1][0]:
+                recent.pop()
+            recent.append((timestamp, latitude, longitude))
+            # A tailed row with an equal timestamp is usually this worker's
+            # own ping coming back, not news.
+            changed = (state.latitude, state.longitude, state.air_quality, state.passenger_count) \
+                != (latitude, longitude, air_quality, passenger_count)
+            state.latitude = latitude
+            state.longitude = longitude
+            state.timestamp = timestamp
+            state.air_quality = air_quality
+            state.passenger_count = passenger_count
+        else:
+            return state
+        self.version += 1
+        if changed and notify:
+            for listener in self._listeners:
+                listener(state)
+        return state
+
+    def add_listener(self, listener):
+        # Called with the BusState, under the store lock, whenever a bus changes.
+        self._listeners.append(listener)
+
+    def update(self, ping):
+        if self._pid != os.getpid():
+            self.sync()
+        with self._lock:
+            return self._apply(ping.bus_no, ping.latitude, ping.longitude, ping.timestamp,
+                               ping.air_quality, ping.passenger_count)
+
+    def warm(self):
+        rows, last_id = storage.telemetry.latest()
+        with self._lock:
+            self._buses = {}
+            self._recent = {}
+            self.version += 1
+            for row in rows:
+                self._apply(*row, notify=False)
+            self._last_id = last_id
+            self._refreshed_at = time.monotonic()
+            self._pid = os.getpid()
+
+    def refresh(self):
+        rows = storage.telemetry.since(self._last_id)
+        with self._lock:
+            for row in rows:
+                self._apply(*row[1:], tailing=True)
+            if rows:
+                self._last_id = rows[-1][0]
+            self._refreshed_at = time.monotonic()
+
+    def sync(self):
+        if self._pid == os.getpid() and time.monotonic() - self._refreshed_at < self.refresh_interval:
+            return
+        # One thread catches up while the others serve what is already cached.
+        blocking = self._pid != os.getpid()
+        if not self._refresh_lock.acquire(blocking):
+            return
+        try:
+            if self._pid != os.getpid():
+                self.warm()
+            else:
+                self.refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def get(self, bus_no):
+        self.sync()
+        return self._buses.get(bus_no)
+
+    def recent(self, bus_no):
+        # Up to RECENT_FIXES (timestamp, latitude, longitude), oldest first.
+        self.sync()
+        with self._lock:
+            return list(self._recent.get(bus_no, ()))
+
+    def all(self):
+        return self.snapshot()[1]
+
+    def snapshot(self):
+        self.sync()
+        with self._lock:
+            return self.version, list(self._buses.values())
+
+    def __len__(self):
+        return len(self._buses)
+
+
+store = LatestStore()
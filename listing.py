@@ -0,0 +1,40 @@
+import collections
+import threading
+
+import storage
+
+MAX_PER_PAGE = 500
+CACHE_ENTRIES = 128
+
+
+class ResponseCache:
+    """Small LRU of rendered responses, keyed on the tables' fingerprint."""
+
+    def __init__(self, entries=CACHE_ENTRIES):
+        self.entries = entries
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key, render):
+        key = (storage.buses.fingerprint(),) + key
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+        value = render()
+        with self._lock:
+            self._cache[key] = value
+            while len(self._cache) > self.entries:
+                self._cache.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+
+
+cache = ResponseCache()
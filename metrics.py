@@ -0,0 +1,430 @@
+"""Request and ingest instrumentation, exported as Prometheus text at /metrics.
+
+Each process appends its samples to its own mmap-backed file under
+SMARTBUS_METRICS_DIR. The /metrics handler sums the files of every worker.
+Counters and histograms include workers that have since exited, so their
+totals never go backwards. Gauges include only live workers. gunicorn.conf.py
+empties the directory when the master starts.
+
+Request latency is measured from before_request to after_request. For a
+streamed response this is the time to the first byte. DB time is spent
+inside sqlite3 calls on pooled connections. Serialization time is spent in
+the app's JSON provider and in template rendering.
+"""
+import bisect
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+from flask import has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from flask.signals import before_render_template, template_rendered
+
+ENABLED = os.environ.get('SMARTBUS_METRICS', '1') not in ('0', '')
+DIRECTORY = os.environ.get('SMARTBUS_METRICS_DIR', 'metrics')
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKET_LABELS = tuple('%g' % b for b in BUCKETS) + ('+Inf',)
+
+# name: (type, help)
+METRICS = {
+    'smartbus_requests_total': ('counter', 'Requests handled, by endpoint, method and status.'),
+    'smartbus_request_duration_seconds': ('histogram', 'Request latency up to the first byte.'),
+    'smartbus_request_db_seconds_total': ('counter', 'Time requests spent in SQLite calls.'),
+    'smartbus_request_serialize_seconds_total': ('counter', 'Time requests spent building JSON and HTML.'),
+    'smartbus_requests_in_flight': ('gauge', 'Requests currently being handled.'),
+    'smartbus_ingest_queue_depth': ('gauge', 'Pings waiting in the write-behind queues.'),
+    'smartbus_ingest_batch_seconds': ('histogram', 'Time to commit one ingest batch.'),
+    'smartbus_ingest_rows_total': ('counter', 'Pings committed by the ingest writers.'),
+}
+
+_HEADER = struct.Struct('<Q')
+_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+
+class ValueFile:
+    """Append-only map of sample key to float64 in one mmap-backed file.
+
+    Only the owning process writes. An entry is its key length, the key
+    (padded to 8 bytes), then the value. The header holds the bytes in use
+    and is written last, so a reader never sees a half-written entry.
+
+    A file left by an exited worker whose pid is reused is picked up where
+    it stopped: its counters keep their totals and its gauges go back to 0.
+    """
+
+    def __init__(self, path, initial_size=1 << 16):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        self._size = max(os.fstat(self._fd).st_size, initial_size)
+        os.ftruncate(self._fd, self._size)
+        self._map = mmap.mmap(self._fd, self._size)
+        self._positions = {}
+        self._used = _HEADER.size
+        for key, position, end in _entries(self._map):
+            self._positions[key] = position
+            self._used = end
+            if METRICS.get(key.split('|', 1)[0], ('',))[0] == 'gauge':
+                _VALUE.pack_into(self._map, position, 0.0)
+        _HEADER.pack_into(self._map, 0, self._used)
+
+    def _append(self, key):
+        encoded = key.encode()
+        padded = (_LENGTH.size + len(encoded) + 7) & ~7
+        needed = self._used + padded + _VALUE.size
+        if needed > self._size:
+            size = self._size
+            while size < needed:
+                size *= 2
+            self._map.close()
+            os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+            self._size = size
+        _LENGTH.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + _LENGTH.size:self._used + _LENGTH.size + len(encoded)] = encoded
+        position = self._used + padded
+        _VALUE.pack_into(self._map, position, 0.0)
+        self._positions[key] = position
+        self._used = needed
+        _HEADER.pack_into(self._map, 0, self._used)
+        return position
+
+    def add(self, key, amount):
+        position = self._positions.get(key)
+        if position is None:
+            position = self._append(key)
+        _VALUE.pack_into(self._map, position, _VALUE.unpack_from(self._map, position)[0] + amount)
+
+    def set(self, key, value):
+        position = self._positions.get(key)
+        if position is None:
+            position = self._append(key)
+        _VALUE.pack_into(self._map, position, value)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+def _entries(data):
+    # (key, value position, end of entry) for every complete entry.
+    if len(data) < _HEADER.size:
+        return
+    used = min(_HEADER.unpack_from(data, 0)[0], len(data))
+    offset = _HEADER.size
+    while offset + _LENGTH.size <= used:
+        length = _LENGTH.unpack_from(data, offset)[0]
+        padded = (_LENGTH.size + length + 7) & ~7
+        if offset + padded + _VALUE.size > used:
+            break
+        key = bytes(data[offset + _LENGTH.size:offset + _LENGTH.size + length]).decode()
+        offset += padded + _VALUE.size
+        yield key, offset - _VALUE.size, offset
+
+
+def read_values(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    for key, position, _ in _entries(data):
+        yield key, _VALUE.unpack_from(data, position)[0]
+
+
+def _alive(pid):
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        # os.kill(pid, 0) terminates the process on Windows.
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def sample_key(name, labels='', le=''):
+    return '%s|%s|%s' % (name, labels, le)
+
+
+class Registry:
+    """Per-process writer for the shared metrics directory."""
+
+    def __init__(self, directory=DIRECTORY):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def _values(self):
+        if self._pid != os.getpid():
+            # A forked worker must not write into its parent's file.
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = ValueFile(os.path.join(self.directory, '%d.metrics' % os.getpid()))
+            self._pid = os.getpid()
+        return self._file
+
+    def add(self, key, amount=1.0):
+        with self._lock:
+            self._values().add(key, amount)
+
+    def add_many(self, pairs):
+        with self._lock:
+            values = self._values()
+            for key, amount in pairs:
+                values.add(key, amount)
+
+    def set(self, key, value):
+        with self._lock:
+            self._values().set(key, value)
+
+    def observe(self, name, labels, seconds, extra=()):
+        le = BUCKET_LABELS[bisect.bisect_left(BUCKETS, seconds)]
+        self.add_many([
+            (sample_key(name + '_bucket', labels, le), 1),
+            (sample_key(name + '_sum', labels), seconds),
+            (sample_key(name + '_count', labels), 1),
+        ] + list(extra))
+
+    def collect(self):
+        """{key: value} summed over every worker's file."""
+        totals = {}
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return totals
+        for filename in names:
+            pid, ext = os.path.splitext(filename)
+            if ext != '.metrics' or not pid.isdigit():
+                continue
+            alive = None
+            try:
+                for key, value in read_values(os.path.join(self.directory, filename)):
+                    if METRICS.get(key.split('|', 1)[0], ('',))[0] == 'gauge':
+                        if alive is None:
+                            alive = _alive(int(pid))
+                        if not alive:
+                            continue
+                    totals[key] = totals.get(key, 0.0) + value
+            except FileNotFoundError:
+                continue
+        return totals
+
+    def render(self):
+        totals = self.collect()
+        series = {}
+        for key, value in totals.items():
+            name, labels, le = key.split('|')
+            series.setdefault(name, []).append((labels, le, value))
+
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            if kind == 'histogram':
+                samples = series.get(name + '_bucket')
+                if not samples:
+                    continue
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s histogram' % name)
+                by_labels = {}
+                for labels, le, value in samples:
+                    by_labels.setdefault(labels, {})[le] = value
+                for labels in sorted(by_labels):
+                    counts, cumulative = by_labels[labels], 0.0
+                    prefix = labels + ',' if labels else ''
+                    for le in BUCKET_LABELS:
+                        cumulative += counts.get(le, 0.0)
+                        lines.append('%s_bucket{%sle="%s"} %s' % (name, prefix, le, _number(cumulative)))
+                    for suffix in ('_sum', '_count'):
+                        value = totals.get(sample_key(name + suffix, labels), 0.0)
+                        lines.append('%s%s%s %s' % (name, suffix, _braces(labels), _number(value)))
+            else:
+                samples = series.get(name)
+                if not samples:
+                    continue
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for labels, _, value in sorted(samples):
+                    lines.append('%s%s %s' % (name, _braces(labels), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = None
+            self._pid = None
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for filename in names:
+            if filename.endswith('.metrics'):
+                os.remove(os.path.join(self.directory, filename))
+
+
+def _braces(labels):
+    return '{%s}' % labels if labels else ''
+
+
+def _number(value):
+    return repr(int(value)) if value == int(value) else repr(value)
+
+
+registry = Registry()
+
+
+# Per-request timings live in the request's WSGI environ rather than a
+# thread-local: under gevent every greenlet in a worker shares one thread.
+_TIMES = 'smartbus.metrics'
+
+
+def _request_times():
+    return request.environ.get(_TIMES) if has_request_context() else None
+
+
+def _add(name, seconds):
+    # DB calls from background threads belong to no request.
+    times = _request_times()
+    if times is not None:
+        times[name] += seconds
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            _add('db', time.perf_counter() - start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            _add('db', time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            _add('db', time.perf_counter() - start)
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            _add('db', time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _add('db', time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements and commits add to the request's DB time."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute does not go through cursor(), so route it there.
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            _add('db', time.perf_counter() - start)
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            _add('serialize', time.perf_counter() - start)
+
+
+_IN_FLIGHT = sample_key('smartbus_requests_in_flight')
+_route_labels = {}
+
+
+def _labels(endpoint, method):
+    labels = _route_labels.get((endpoint, method))
+    if labels is None:
+        labels = _route_labels[(endpoint, method)] = 'endpoint="%s",method="%s"' % (endpoint, method)
+    return labels
+
+
+def _before_request():
+    request.environ[_TIMES] = {'start': time.perf_counter(), 'db': 0.0, 'serialize': 0.0,
+                               'render_start': None}
+    registry.add(_IN_FLIGHT, 1)
+
+
+def _after_request(response):
+    times = request.environ.pop(_TIMES, None)
+    if times is None:
+        return response
+    elapsed = time.perf_counter() - times['start']
+    labels = _labels(request.endpoint or 'unmatched', request.method)
+    registry.observe('smartbus_request_duration_seconds', labels, elapsed, extra=[
+        (sample_key('smartbus_requests_total', '%s,status="%d"' % (labels, response.status_code)), 1),
+        (sample_key('smartbus_request_db_seconds_total', labels), times['db']),
+        (sample_key('smartbus_request_serialize_seconds_total', labels), times['serialize']),
+        (_IN_FLIGHT, -1),
+    ])
+    return response
+
+
+def _template_started(sender, **extra):
+    times = _request_times()
+    if times is not None:
+        times['render_start'] = time.perf_counter()
+
+
+def _template_done(sender, **extra):
+    times = _request_times()
+    if times is not None and times['render_start'] is not None:
+        times['serialize'] += time.perf_counter() - times['render_start']
+        times['render_start'] = None
+
+
+def record_ingest_batch(rows, seconds, queued):
+    if not ENABLED:
+        return
+    registry.observe('smartbus_ingest_batch_seconds', '', seconds, extra=[
+        (sample_key('smartbus_ingest_rows_total'), rows),
+    ])
+    set_queue_depth(queued)
+
+
+def set_queue_depth(queued):
+    if ENABLED:
+        registry.set(sample_key('smartbus_ingest_queue_depth'), queued)
+
+
+def init_app(app):
+    if not ENABLED:
+        return
+    app.json = TimedJSONProvider(app)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_done, app)
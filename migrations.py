@@ -0,0 +1,180 @@
+import logging
+
+import partitions
+
+log = logging.getLogger(__name__)
+
+
+def _baseline(conn):
+    # The tables init_db used to create; existing databases already have them.
+    conn.execute('''CREATE TABLE IF NOT EXISTS routes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        route_no TEXT NOT NULL,
+        path TEXT NOT NULL
+    )''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS buses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bus_no TEXT NOT NULL,
+        route_no TEXT NOT NULL
+    )''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS gps_data (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bus_no TEXT,
+        latitude REAL,
+        longitude REAL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS bus_status (
+        bus_no TEXT PRIMARY KEY,
+        air_quality INTEGER,
+        passenger_count INTEGER
+    )''')
+
+
+def _indexes(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_gps_data_bus_time ON gps_data (bus_no, timestamp)')
+
+    # Older databases may hold duplicates; the most recently added row wins.
+    conn.execute('''DELETE FROM buses WHERE id NOT IN (
+        SELECT MAX(id) FROM buses GROUP BY bus_no)''')
+    conn.execute('''DELETE FROM routes WHERE id NOT IN (
+        SELECT MAX(id) FROM routes GROUP BY route_no)''')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_buses_bus_no ON buses (bus_no)')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_routes_route_no ON routes (route_no)')
+
+
+def _bus_latest(conn):
+    # One row per bus, upserted by the ingest writer alongside gps_data.
+    conn.execute('''CREATE TABLE IF NOT EXISTS bus_latest (
+        bus_no TEXT PRIMARY KEY,
+        latitude REAL,
+        longitude REAL,
+        timestamp DATETIME,
+        air_quality INTEGER,
+        passenger_count INTEGER
+    )''')
+    conn.execute('''
+        INSERT OR REPLACE INTO bus_latest
+            (bus_no, latitude, longitude, timestamp, air_quality, passenger_count)
+        SELECT g.bus_no, g.latitude, g.longitude, MAX(g.timestamp),
+               s.air_quality, s.passenger_count
+        FROM gps_data g LEFT JOIN bus_status s ON s.bus_no = g.bus_no
+        GROUP BY g.bus_no
+    ''')
+
+
+def _partition_gps_data(conn):
+    conn.execute('''CREATE TABLE gps_partitions (
+        day TEXT PRIMARY KEY,
+        resolution INTEGER NOT NULL DEFAULT 0
+    )''')
+    conn.execute('CREATE TABLE gps_sequence (last_id INTEGER NOT NULL)')
+    conn.execute('INSERT INTO gps_sequence SELECT COALESCE(MAX(id), 0) FROM gps_data')
+    conn.execute('''CREATE TABLE maintenance_leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT,
+        expires REAL
+    )''')
+
+    # Move existing history into day tables, keeping ids.
+    columns = 'id, bus_no, latitude, longitude, timestamp'
+    days = conn.execute('SELECT DISTINCT substr(timestamp, 1, 10) FROM gps_data').fetchall()
+    if len(days) > partitions.MAX_PARTITIONS:
+        raise RuntimeError(
+            'gps_data spans %d days, but at most %d day partitions fit in the gps_data view; '
+            'delete older history before upgrading' % (len(days), partitions.MAX_PARTITIONS))
+    for (day,) in days:
+        partitions.create_partition(conn, day)
+        conn.execute('''INSERT INTO %s (%s)
+            SELECT %s FROM gps_data WHERE substr(timestamp, 1, 10) = ?''' % (
+            partitions.table_name(day), columns, columns), (day,))
+    conn.execute('DROP TABLE gps_data')
+    partitions.rebuild_view(conn)
+
+
+def _covering_history_index(conn):
+    for day in partitions.days(conn):
+        conn.execute('DROP INDEX IF EXISTS idx_%s_bus_time' % partitions.table_name(day))
+        partitions.create_partition(conn, day)
+
+
+def _buses_route_index(conn):
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_buses_route_no ON buses (route_no)')
+
+
+def _snapped_columns(conn):
+    # Partitions created since migration 4 may already have the columns.
+    for day in partitions.days(conn):
+        table = partitions.table_name(day)
+        existing = {row[1] for row in conn.execute('PRAGMA table_info(%s)' % table)}
+        for column, kind in (('snapped_latitude', 'REAL'), ('snapped_longitude', 'REAL'),
+                             ('progress', 'REAL'), ('off_route', 'INTEGER')):
+            if column not in existing:
+                conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, kind))
+    partitions.rebuild_view(conn)
+
+
+def _bus_latest_last_seen(conn):
+    # Heartbeat: when the bus last reported, even if the fix was not stored.
+    conn.execute('ALTER TABLE bus_latest ADD COLUMN last_seen DATETIME')
+    conn.execute('UPDATE bus_latest SET last_seen = timestamp')
+
+
+def _stop_events(conn):
+    conn.execute('''CREATE TABLE stop_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        bus_no TEXT NOT NULL,
+        route_no TEXT NOT NULL,
+        stop_index INTEGER NOT NULL,
+        event TEXT NOT NULL CHECK (event IN ('arrival', 'departure')),
+        timestamp DATETIME NOT NULL,
+        dwell_s REAL
+    )''')
+    # Headways walk one stop's events in time order; punctuality one bus's.
+    conn.execute('''CREATE INDEX idx_stop_events_stop_time
+        ON stop_events (route_no, stop_index, timestamp)''')
+    conn.execute('CREATE INDEX idx_stop_events_bus_time ON stop_events (bus_no, timestamp)')
+    # Detection starts with new fixes rather than replaying all of history.
+    conn.execute('CREATE TABLE stop_events_cursor (last_id INTEGER NOT NULL)')
+    conn.execute('INSERT INTO stop_events_cursor SELECT last_id FROM gps_sequence')
+
+
+# Append only: a database at user_version N has run every step up to N.
+MIGRATIONS = [
+    (1, 'baseline tables', _baseline),
+    (2, 'gps_data/buses/routes indexes', _indexes),
+    (3, 'bus_latest table', _bus_latest),
+    (4, 'per-day gps_data partitions', _partition_gps_data),
+    (5, 'covering bus/time index on partitions', _covering_history_index),
+    (6, 'buses.route_no index', _buses_route_index),
+    (7, 'snap-to-route columns on gps_data partitions', _snapped_columns),
+    (8, 'bus_latest.last_seen heartbeat', _bus_latest_last_seen),
+    (9, 'stop_events table', _stop_events),
+]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    for number, description, step in MIGRATIONS:
+        if number <= current_version(conn):
+            continue
+        # BEGIN IMMEDIATE serialises workers racing to upgrade the same file.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if number <= current_version(conn):
+                conn.rollback()
+                continue
+            step(conn)
+            conn.execute('PRAGMA user_version = %d' % number)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        log.info('applied migration %d: %s', number, description)
+    return current_version(conn)
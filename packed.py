@@ -0,0 +1,64 @@
+import struct
+import time
+
+from ingest import Ping, parse_timestamp, utc_timestamp
+
+# One fixed-size little-endian record per fix, 32 bytes:
+#   16s  bus_no, ASCII, NUL padded
+#   i    latitude in microdegrees
+#   i    longitude in microdegrees
+#   H    air quality index, 0xFFFF when the sensor has no reading
+#   H    passenger count, 0xFFFF when unknown
+#   I    device time, unix seconds UTC; 0 means "stamp on receipt"
+# A request body is any number of records back to back.
+RECORD = struct.Struct('<16siiHHI')
+MISSING = 0xFFFF
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def decode(body):
+    view = memoryview(body)
+    if not view.nbytes or view.nbytes % RECORD.size:
+        raise DecodeError('body must be a whole number of %d-byte records' % RECORD.size)
+
+    now = time.time()
+    received = utc_timestamp(now)
+    pings = []
+    for raw_bus, lat, lng, aqi, passengers, device_time in RECORD.iter_unpack(view):
+        bus_no = raw_bus.rstrip(b'\0').decode('ascii', 'replace')
+        if not bus_no:
+            raise DecodeError('record %d has no bus_no' % len(pings))
+        if not (-90000000 <= lat <= 90000000 and -180000000 <= lng <= 180000000):
+            raise DecodeError('record %d has coordinates out of range' % len(pings))
+        timestamp = received
+        if device_time:
+            # A clock far ahead would win every "newest fix" comparison and
+            # freeze the bus; the same skew and retention checks as JSON fixes.
+            try:
+                timestamp = parse_timestamp(device_time, now)
+            except ValueError as e:
+                raise DecodeError('record %d: %s' % (len(pings), e))
+        pings.append(Ping(
+            bus_no,
+            lat / 1e6,
+            lng / 1e6,
+            None if aqi == MISSING else aqi,
+            None if passengers == MISSING else passengers,
+            timestamp,
+        ))
+    return pings
+
+
+def encode(bus_no, latitude, longitude, air_quality=None, passenger_count=None, device_time=0):
+    # Reference encoder for device firmware and the load tools.
+    return RECORD.pack(
+        bus_no.encode('ascii'),
+        round(latitude * 1e6),
+        round(longitude * 1e6),
+        MISSING if air_quality is None else air_quality,
+        MISSING if passenger_count is None else passenger_count,
+        int(device_time),
+    )
@@ -0,0 +1,253 @@
+"""Per-day partitioning of GPS history.
+
+Fixes live in one table per UTC day (gps_data_YYYYMMDD) listed in
+gps_partitions, and gps_data is a UNION ALL view over them, so readers keep
+querying gps_data as before. ids come from gps_sequence and stay unique and
+increasing across partitions. A compactor downsamples old days and drops
+whole partitions once they pass retention.
+
+Run one compaction pass by hand with ``python partitions.py``.
+"""
+import datetime
+import logging
+import os
+import socket
+import threading
+import time
+
+import db
+
+log = logging.getLogger(__name__)
+
+RETENTION_DAYS = int(os.environ.get('SMARTBUS_HISTORY_RETENTION_DAYS', '365'))
+# SQLite allows at most 500 terms in one compound SELECT, so the gps_data
+# view can join at most this many day tables.
+MAX_PARTITIONS = 500
+# Retention keeps RETENTION_DAYS + 1 days; leave room for a day ahead (clock
+# skew) and an expired day the compactor has not dropped yet.
+MAX_RETENTION_DAYS = MAX_PARTITIONS - 3
+if RETENTION_DAYS > MAX_RETENTION_DAYS:
+    raise ValueError('SMARTBUS_HISTORY_RETENTION_DAYS is %d; at most %d days fit in the gps_data view'
+                     % (RETENTION_DAYS, MAX_RETENTION_DAYS))
+COMPACT_INTERVAL = int(os.environ.get('SMARTBUS_HISTORY_COMPACT_INTERVAL', '3600'))
+
+# (age in days, seconds per fix kept per bus), coarsest last.
+DOWNSAMPLE = (
+    (7, 30),
+    (90, 300),
+)
+
+COLUMNS = '''
+    id INTEGER PRIMARY KEY,
+    bus_no TEXT,
+    latitude REAL,
+    longitude REAL,
+    timestamp DATETIME,
+    snapped_latitude REAL,
+    snapped_longitude REAL,
+    progress REAL,
+    off_route INTEGER
+'''
+COLUMN_NAMES = ('id, bus_no, latitude, longitude, timestamp, '
+                'snapped_latitude, snapped_longitude, progress, off_route')
+
+
+def retention_cutoff(now=None):
+    # Oldest day still kept, as 'YYYY-MM-DD'.
+    now = time.time() if now is None else now
+    return time.strftime('%Y-%m-%d', time.gmtime(now - RETENTION_DAYS * 86400))
+
+
+def table_name(day):
+    # day is 'YYYY-MM-DD', the first ten characters of a stored timestamp.
+    return 'gps_data_' + day.replace('-', '')
+
+
+def create_partition(conn, day):
+    table = table_name(day)
+    conn.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (table, COLUMNS))
+    # Covering index: per-bus history reads never touch the table itself.
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_%s_bus_time '
+                 'ON %s (bus_no, timestamp, latitude, longitude)' % (table, table))
+    conn.execute('INSERT OR IGNORE INTO gps_partitions (day) VALUES (?)', (day,))
+
+
+def days(conn):
+    return [r[0] for r in conn.execute('SELECT day FROM gps_partitions ORDER BY day')]
+
+
+def rebuild_view(conn):
+    existing = days(conn)
+    if len(existing) > MAX_PARTITIONS:
+        raise ValueError('%d day partitions, but the gps_data view can join at most %d; '
+                         'run compaction to drop expired days' % (len(existing), MAX_PARTITIONS))
+    conn.execute('DROP VIEW IF EXISTS gps_data')
+    selects = ['SELECT %s FROM %s' % (COLUMN_NAMES, table_name(day)) for day in existing]
+    if not selects:
+        nulls = ', '.join('NULL AS ' + name for name in COLUMN_NAMES.split(', '))
+        selects = ['SELECT %s FROM (SELECT %s) WHERE 0' % (COLUMN_NAMES, nulls)]
+    conn.execute('CREATE VIEW gps_data AS ' + ' UNION ALL '.join(selects))
+
+
+class Partitions:
+    """Routes inserts to the right day table, creating it on first use."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._known = set()
+
+    def forget(self, day=None):
+        with self._lock:
+            if day is None:
+                self._known.clear()
+            else:
+                self._known.discard(day)
+
+    def insert(self, conn, rows):
+        # rows: (bus_no, latitude, longitude, timestamp, snapped_latitude,
+        # snapped_longitude, progress, off_route) tuples. Fixes for days
+        # already past retention are dropped; their partition may be gone.
+        cutoff = retention_cutoff()
+        rows = [row for row in rows if row[3][:10] >= cutoff]
+        if not rows:
+            return
+        last_id = conn.execute(
+            'UPDATE gps_sequence SET last_id = last_id + ? RETURNING last_id',
+            (len(rows),)).fetchone()[0]
+        first_id = last_id - len(rows) + 1
+
+        by_day = {}
+        for offset, row in enumerate(rows):
+            by_day.setdefault(row[3][:10], []).append((first_id + offset,) + tuple(row))
+
+        with self._lock:
+            new_days = [day for day in by_day if day not in self._known]
+        if new_days:
+            existing = set(days(conn))
+            missing = [day for day in new_days if day not in existing]
+            for day in missing:
+                create_partition(conn, day)
+            if missing:
+                rebuild_view(conn)
+            with self._lock:
+                self._known.update(new_days)
+
+        for day, day_rows in by_day.items():
+            conn.executemany(
+                'INSERT INTO %s (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)' % (
+                    table_name(day), COLUMN_NAMES),
+                day_rows)
+
+
+def claim_lease(conn, name, holder, ttl):
+    """Take or renew the named maintenance lease for ttl seconds.
+
+    True when holder now owns it. Only one worker across the deployment
+    runs the job the lease is named after at a time.
+    """
+    now = time.time()
+    conn.execute('INSERT OR IGNORE INTO maintenance_leases (name, holder, expires) VALUES (?, NULL, 0)',
+                 (name,))
+    cur = conn.execute('''
+        UPDATE maintenance_leases SET holder = ?, expires = ?
+        WHERE name = ? AND (expires < ? OR holder = ?)
+    ''', (holder, now + ttl, name, now, holder))
+    conn.commit()
+    return cur.rowcount == 1
+
+
+def compact(conn, today=None):
+    """Downsample aging partitions and drop expired ones. Returns a summary."""
+    today = today or datetime.datetime.utcnow().date()
+    summary = {'downsampled': [], 'dropped': []}
+    rows = conn.execute('SELECT day, resolution FROM gps_partitions ORDER BY day').fetchall()
+
+    expired = [day for day, _ in rows
+               if (today - datetime.date.fromisoformat(day)).days > RETENTION_DAYS]
+    if expired:
+        # Tables and view change together so readers never see a dangling view.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for day in expired:
+                conn.execute('DROP TABLE IF EXISTS %s' % table_name(day))
+                conn.execute('DELETE FROM gps_partitions WHERE day = ?', (day,))
+            rebuild_view(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        for day in expired:
+            partitions.forget(day)
+        summary['dropped'] = expired
+
+    for day, resolution in rows:
+        if day in expired:
+            continue
+        age = (today - datetime.date.fromisoformat(day)).days
+        target = 0
+        for min_age, seconds in DOWNSAMPLE:
+            if age >= min_age:
+                target = seconds
+        if target <= resolution:
+            continue
+        # Keep the first fix per bus in each bucket of `target` seconds.
+        table = table_name(day)
+        conn.execute('''
+            DELETE FROM %s WHERE id NOT IN (
+                SELECT MIN(id) FROM %s
+                GROUP BY bus_no, CAST(strftime('%%s', timestamp) AS INTEGER) / ?)
+        ''' % (table, table), (target,))
+        conn.execute('UPDATE gps_partitions SET resolution = ? WHERE day = ?', (target, day))
+        conn.commit()
+        summary['downsampled'].append(day)
+    return summary
+
+
+class Compactor:
+    """Background thread in every worker; the lease lets only one do the work."""
+
+    def __init__(self, interval=COMPACT_INTERVAL):
+        self.interval = interval
+        self.holder = '%s:%d' % (socket.gethostname(), os.getpid())
+        self._lock = threading.Lock()
+        self._pid = None
+        self.last_run = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid() or self.interval <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.holder = '%s:%d' % (socket.gethostname(), self._pid)
+            threading.Thread(target=self._run, name='history-compactor', daemon=True).start()
+
+    def run_once(self):
+        with db.pool.connection() as conn:
+            if not claim_lease(conn, 'compactor', self.holder, self.interval):
+                return None
+            # Dropping and downsampling day tables can take a while.
+            summary = db.blocking(compact, conn)
+        self.last_run = summary
+        if summary['downsampled'] or summary['dropped']:
+            log.info('history compaction: %s', summary)
+        return summary
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                log.exception('history compaction failed')
+            time.sleep(self.interval)
+
+
+partitions = Partitions()
+compactor = Compactor()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    with db.pool.connection() as conn:
+        print(compact(conn))
@@ -0,0 +1,266 @@
+"""PostgreSQL (and TimescaleDB) storage backend.
+
+Selected with SMARTBUS_STORAGE=postgres and configured by SMARTBUS_PG_DSN.
+Needs psycopg 3 with its pool (``pip install "psycopg[binary,pool]"``).
+History goes in with COPY. When the timescaledb extension is installed,
+gps_data becomes a hypertable on its timestamp column.
+
+Timestamps are stored as UTC ``timestamp`` values and read back as the same
+'YYYY-MM-DD HH:MM:SS.fff' text that the SQLite backend uses.
+"""
+import logging
+import os
+import threading
+
+import storage
+
+try:
+    import psycopg
+    import psycopg_pool
+except ImportError:
+    psycopg = psycopg_pool = None
+
+log = logging.getLogger(__name__)
+
+DSN = os.environ.get('SMARTBUS_PG_DSN', 'postgresql://localhost/smartbus')
+POOL_SIZE = int(os.environ.get('SMARTBUS_PG_POOL', '8'))
+# Telemetry writers serialise on this advisory lock so ids commit in order;
+# the latest-state store tails history by id and would skip late commits.
+WRITE_LOCK = 0x5b05
+
+TEXT_TIME = "to_char(%s, 'YYYY-MM-DD HH24:MI:SS.MS')"
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS routes (
+        id BIGSERIAL PRIMARY KEY,
+        route_no TEXT NOT NULL UNIQUE,
+        path TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS buses (
+        id BIGSERIAL PRIMARY KEY,
+        bus_no TEXT NOT NULL UNIQUE,
+        route_no TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_buses_route_no ON buses (route_no)',
+    '''CREATE TABLE IF NOT EXISTS gps_data (
+        id BIGSERIAL,
+        bus_no TEXT,
+        latitude DOUBLE PRECISION,
+        longitude DOUBLE PRECISION,
+        timestamp TIMESTAMP NOT NULL,
+        snapped_latitude DOUBLE PRECISION,
+        snapped_longitude DOUBLE PRECISION,
+        progress DOUBLE PRECISION,
+        off_route SMALLINT
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_gps_data_id ON gps_data (id)',
+    '''CREATE INDEX IF NOT EXISTS idx_gps_data_bus_time
+        ON gps_data (bus_no, timestamp) INCLUDE (latitude, longitude)''',
+    '''CREATE TABLE IF NOT EXISTS bus_status (
+        bus_no TEXT PRIMARY KEY,
+        air_quality INTEGER,
+        passenger_count INTEGER
+    )''',
+    '''CREATE TABLE IF NOT EXISTS bus_latest (
+        bus_no TEXT PRIMARY KEY,
+        latitude DOUBLE PRECISION,
+        longitude DOUBLE PRECISION,
+        timestamp TIMESTAMP,
+        air_quality INTEGER,
+        passenger_count INTEGER,
+        last_seen TIMESTAMP
+    )''',
+]
+
+
+class PostgresBackend:
+    """Connection pool shared by the three Postgres stores, one per process."""
+
+    def __init__(self, dsn=DSN, size=POOL_SIZE):
+        self.dsn = dsn
+        self.size = size
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+
+    def connection(self):
+        if psycopg is None:
+            raise RuntimeError('SMARTBUS_STORAGE=postgres needs psycopg[pool] installed')
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Connections must not be shared across a fork.
+                    self._pool = psycopg_pool.ConnectionPool(
+                        self.dsn, min_size=1, max_size=self.size, open=True)
+                    self._pid = os.getpid()
+        return self._pool.connection()
+
+    def migrate(self):
+        with self.connection() as conn:
+            conn.execute('SELECT pg_advisory_xact_lock(%s)', (WRITE_LOCK,))
+            for statement in SCHEMA:
+                conn.execute(statement)
+            timescale = conn.execute(
+                "SELECT 1 FROM pg_extension WHERE extname = 'timescaledb'").fetchone()
+            if timescale:
+                conn.execute("SELECT create_hypertable('gps_data', 'timestamp', "
+                             "if_not_exists => TRUE, migrate_data => TRUE)")
+        log.info('postgres schema ready (timescaledb: %s)', bool(timescale))
+
+    def close(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.close()
+        self._pool = None
+        self._pid = None
+
+
+class PostgresRouteStore(storage.RouteStore):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def add(self, route_no, path):
+        try:
+            with self.backend.connection() as conn:
+                conn.execute('INSERT INTO routes (route_no, path) VALUES (%s, %s)', (route_no, path))
+        except psycopg.errors.UniqueViolation:
+            raise storage.Conflict(route_no)
+
+    def all(self):
+        with self.backend.connection() as conn:
+            return conn.execute('SELECT id, route_no, path FROM routes ORDER BY id').fetchall()
+
+
+class PostgresBusStore(storage.BusStore):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def add(self, bus_no, route_no):
+        try:
+            with self.backend.connection() as conn:
+                conn.execute('INSERT INTO buses (bus_no, route_no) VALUES (%s, %s)', (bus_no, route_no))
+        except psycopg.errors.UniqueViolation:
+            raise storage.Conflict(bus_no)
+
+    def delete(self, bus_id):
+        with self.backend.connection() as conn:
+            conn.execute('DELETE FROM buses WHERE id = %s', (bus_id,))
+
+    def all(self):
+        with self.backend.connection() as conn:
+            return conn.execute('SELECT id, bus_no, route_no FROM buses ORDER BY id').fetchall()
+
+    def fingerprint(self):
+        with self.backend.connection() as conn:
+            return conn.execute('''
+                SELECT (SELECT COUNT(*) FROM buses), (SELECT MAX(id) FROM buses),
+                       (SELECT COUNT(*) FROM routes), (SELECT MAX(id) FROM routes)
+            ''').fetchone()
+
+    def search(self, q=None, page=1, per_page=50):
+        # Paths are unvalidated JSON text, and casting a bad one fails the
+        # whole query, so stop names are matched here rather than in SQL.
+        with self.backend.connection() as conn:
+            rows = conn.execute('''
+                SELECT b.id, b.bus_no, b.route_no, r.id, r.path
+                FROM buses b JOIN routes r ON r.route_no = b.route_no
+                ORDER BY b.route_no, b.bus_no
+            ''').fetchall()
+        needle = q.lower() if q else None
+        matched = []
+        for bus_id, bus_no, route_no, route_id, path in rows:
+            stops = storage.stop_names(path)
+            if needle is None or any(needle in (text or '').lower()
+                                     for text in [bus_no, route_no] + stops):
+                matched.append(storage.listing_row(bus_id, bus_no, route_no, route_id, stops))
+        start = (page - 1) * per_page
+        return len(matched), matched[start:start + per_page]
+
+
+class PostgresTelemetryStore(storage.TelemetryStore):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def write(self, pings, heartbeats=()):
+        latest = {}
+        for p in pings:
+            newest = latest.get(p.bus_no)
+            if newest is None or p.timestamp >= newest.timestamp:
+                latest[p.bus_no] = p
+
+        # The pool's connection context commits on success and rolls back on error.
+        with self.backend.connection() as conn:
+            conn.execute('SELECT pg_advisory_xact_lock(%s)', (WRITE_LOCK,))
+            with conn.cursor() as cur:
+                with cur.copy('''COPY gps_data (bus_no, latitude, longitude, timestamp,
+                                 snapped_latitude, snapped_longitude, progress, off_route)
+                                 FROM STDIN''') as copy:
+                    for p in pings:
+                        copy.write_row((p.bus_no, p.latitude, p.longitude, p.timestamp)
+                                       + (p.snap or storage.NOT_SNAPPED))
+                cur.executemany('''
+                    INSERT INTO bus_status (bus_no, air_quality, passenger_count)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (bus_no) DO UPDATE SET
+                    air_quality = EXCLUDED.air_quality,
+                    passenger_count = EXCLUDED.passenger_count
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM bus_latest l
+                        WHERE l.bus_no = EXCLUDED.bus_no AND l.timestamp > %s::timestamp)
+                ''', [(p.bus_no, p.air_quality, p.passenger_count, p.timestamp)
+                      for p in latest.values()])
+                cur.executemany('''
+                    INSERT INTO bus_latest (bus_no, latitude, longitude, timestamp,
+                                            air_quality, passenger_count, last_seen)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (bus_no) DO UPDATE SET
+                    latitude = EXCLUDED.latitude,
+                    longitude = EXCLUDED.longitude,
+                    timestamp = EXCLUDED.timestamp,
+                    air_quality = EXCLUDED.air_quality,
+                    passenger_count = EXCLUDED.passenger_count,
+                    last_seen = GREATEST(EXCLUDED.last_seen, bus_latest.last_seen)
+                    WHERE EXCLUDED.timestamp >= bus_latest.timestamp
+                ''', [(p.bus_no, p.latitude, p.longitude, p.timestamp, p.air_quality,
+                       p.passenger_count, p.timestamp) for p in latest.values()])
+                if heartbeats:
+                    cur.executemany('''
+                        UPDATE bus_latest SET last_seen = GREATEST(%s::timestamp, last_seen)
+                        WHERE bus_no = %s
+                    ''', [(p.timestamp, p.bus_no) for p in heartbeats])
+
+    def latest(self):
+        with self.backend.connection() as conn:
+            # Both reads see the same snapshot.
+            conn.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            rows = conn.execute('''
+                SELECT bus_no, latitude, longitude, %s, air_quality, passenger_count
+                FROM bus_latest
+            ''' % (TEXT_TIME % 'timestamp')).fetchall()
+            last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM gps_data').fetchone()[0]
+        return rows, last_id
+
+    def since(self, last_id):
+        with self.backend.connection() as conn:
+            return conn.execute('''
+                SELECT g.id, g.bus_no, g.latitude, g.longitude, %s,
+                       s.air_quality, s.passenger_count
+                FROM gps_data g LEFT JOIN bus_status s ON s.bus_no = g.bus_no
+                WHERE g.id > %%s
+                ORDER BY g.id
+            ''' % (TEXT_TIME % 'g.timestamp'), (last_id,)).fetchall()
+
+    def fixes(self, bus_no, start, end):
+        with self.backend.connection() as conn:
+            cur = conn.execute('''
+                SELECT %s, latitude, longitude FROM gps_data
+                WHERE bus_no = %%s AND timestamp BETWEEN %%s AND %%s
+                ORDER BY timestamp
+            ''' % (TEXT_TIME % 'timestamp'), (bus_no, start, end))
+            while True:
+                rows = cur.fetchmany(storage.FETCH_SIZE)
+                if not rows:
+                    break
+                yield from rows
+
+
+backend = PostgresBackend()
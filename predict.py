@@ -0,0 +1,71 @@
+import math
+import os
+import time
+
+import eta
+import fleet
+import geometry
+import ingest
+import latest
+from geometry import METERS_PER_DEGREE_LAT, METERS_PER_DEGREE_LNG
+
+# Positions are extrapolated at most this far past the last fix; after that
+# the bus is reported where it was last seen.
+MAX_EXTRAPOLATE = float(os.environ.get('SMARTBUS_PREDICT_MAX_S', '30'))
+
+
+def _along_route(route, fixes, ahead):
+    alongs = [route.project(lat, lng)[0] for _, lat, lng in fixes]
+    elapsed = fixes[-1][0] - fixes[0][0]
+    speed = (alongs[-1] - alongs[0]) / elapsed if elapsed > 0 else 0.0
+    if not 0 <= speed <= eta.MAX_SPEED:
+        speed = 0.0
+    along = min(alongs[-1] + speed * ahead, route.length)
+    lat, lng, heading = route.point_at(along)
+    return lat, lng, heading, speed, along
+
+
+def _straight_line(fixes, ahead):
+    (t0, lat0, lng0), (t1, lat1, lng1) = fixes[0], fixes[-1]
+    scale = math.cos(math.radians(lat1)) * METERS_PER_DEGREE_LNG
+    vx = (lng1 - lng0) * scale / (t1 - t0) if t1 > t0 else 0.0
+    vy = (lat1 - lat0) * METERS_PER_DEGREE_LAT / (t1 - t0) if t1 > t0 else 0.0
+    speed = math.hypot(vx, vy)
+    if speed > eta.MAX_SPEED:
+        vx = vy = speed = 0.0
+    heading = math.degrees(math.atan2(vx, vy)) % 360 if speed else None
+    return (lat1 + vy * ahead / METERS_PER_DEGREE_LAT,
+            lng1 + vx * ahead / scale if scale else lng1,
+            heading, speed)
+
+
+def predict(bus_no, at=None):
+    """Dead-reckoned position of a bus now (or at `at`, unix seconds)."""
+    recent = latest.store.recent(bus_no)
+    if not recent:
+        return None
+    at = time.time() if at is None else at
+    fixes = [(ingest.to_epoch(ts), lat, lng) for ts, lat, lng in recent]
+    last_at = fixes[-1][0]
+    ahead = min(max(at - last_at, 0.0), MAX_EXTRAPOLATE)
+    result = {
+        'bus_no': bus_no,
+        'fix_timestamp': recent[-1][0],
+        'age_s': round(max(at - last_at, 0.0), 1),
+        'predicted_at': at,
+    }
+
+    route = geometry.routes.get(fleet.assignments.route_of(bus_no))
+    if route is not None and route.project(fixes[-1][1], fixes[-1][2])[1] <= geometry.OFF_ROUTE_M:
+        lat, lng, heading, speed, along = _along_route(route, fixes, ahead)
+        result.update(method='route', route_no=route.route_no, progress_m=round(along, 1))
+    elif len(fixes) > 1:
+        lat, lng, heading, speed = _straight_line(fixes, ahead)
+        result['method'] = 'linear'
+    else:
+        lat, lng, heading, speed = fixes[-1][1], fixes[-1][2], None, 0.0
+        result['method'] = 'last_fix'
+    result.update(latitude=lat, longitude=lng,
+                  heading=None if heading is None else round(heading, 1),
+                  speed_mps=round(speed, 2))
+    return result
@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+import time
+
+import fleet
+import latest
+
+KEEPALIVE = float(os.environ.get('SMARTBUS_SSE_KEEPALIVE', '15'))
+
+
+class Subscription:
+    """One SSE client. Holds only the newest pending update per bus."""
+
+    def __init__(self, topics):
+        self.topics = topics
+        self._pending = {}
+        self._ready = threading.Event()
+
+    def push(self, bus_no, payload):
+        self._pending[bus_no] = payload
+        self._ready.set()
+
+    def wait(self, timeout):
+        if not self._ready.wait(timeout):
+            return []
+        self._ready.clear()
+        pending, self._pending = self._pending, {}
+        return list(pending.values())
+
+
+class Broker:
+    """Fans bus changes out to subscribers of 'bus:<no>' and 'route:<no>'."""
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._topics = {}
+        self._pid = None
+        self._tailer = None
+        self.published = 0
+        store.add_listener(self.publish)
+
+    def subscribe(self, topics):
+        sub = Subscription(topics)
+        with self._lock:
+            for topic in topics:
+                self._topics.setdefault(topic, set()).add(sub)
+        self._ensure_tailer()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for topic in sub.topics:
+                subs = self._topics.get(topic)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._topics[topic]
+
+    def publish(self, state):
+        # Runs under the latest store's lock: no database access here.
+        if not self._topics:
+            return
+        topics = ['bus:%s' % state.bus_no]
+        route_no = fleet.assignments.route_of(state.bus_no, load=False)
+        if route_no is not None:
+            topics.append('route:%s' % route_no)
+        with self._lock:
+            subs = set()
+            for topic in topics:
+                subs.update(self._topics.get(topic, ()))
+        if not subs:
+            return
+        payload = json.dumps(state.as_dict())
+        for sub in subs:
+            sub.push(state.bus_no, payload)
+        self.published += 1
+
+    def _ensure_tailer(self):
+        if self._tailer is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._tailer is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._tailer = threading.Thread(target=self._tail, name='sse-tailer', daemon=True)
+                self._tailer.start()
+
+    def _tail(self):
+        # Pulls in pings that other workers ingested so their subscribers here
+        # still hear about them; exits once the last subscriber leaves.
+        while True:
+            with self._lock:
+                if not self._topics:
+                    self._tailer = None
+                    return
+            fleet.assignments.load()
+            self.store.sync()
+            time.sleep(self.store.refresh_interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'topics': len(self._topics),
+                'subscribers': sum(len(s) for s in self._topics.values()),
+                'published': self.published,
+            }
+
+
+def event_stream(sub, initial=(), event='position', on_close=None):
+    try:
+        yield 'retry: 5000\n\n'
+        for state in initial:
+            yield 'event: %s\ndata: %s\n\n' % (event, json.dumps(state.as_dict()))
+        while True:
+            payloads = sub.wait(KEEPALIVE)
+            if not payloads:
+                yield ': keepalive\n\n'
+            for payload in payloads:
+                yield 'event: %s\ndata: %s\n\n' % (event, payload)
+    finally:
+        broker.unsubscribe(sub)
+        if on_close is not None:
+            on_close()
+
+
+broker = Broker(latest.store)
@@ -0,0 +1,145 @@
+"""Read path for dashboard and history queries, kept off the writers' pool.
+
+SMARTBUS_READ_MODE picks where those reads go:
+
+    live      the shared read/write pool, as before
+    ro        a separate mode=ro pool on the live file; WAL readers see
+              committed data and can never hold the write lock
+    snapshot  a copy of the database made with the SQLite backup API and
+              refreshed every SMARTBUS_READ_STALENESS seconds; one worker
+              refreshes it at a time and the others pick the new file up
+"""
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from flask import g
+
+import db
+import partitions
+
+log = logging.getLogger(__name__)
+
+MODES = ('live', 'ro', 'snapshot')
+MODE = os.environ.get('SMARTBUS_READ_MODE', 'ro')
+STALENESS = float(os.environ.get('SMARTBUS_READ_STALENESS', '5'))
+
+
+class Replica:
+    def __init__(self, mode=MODE, staleness=STALENESS, snapshot_file=None):
+        if mode not in MODES:
+            raise ValueError('unknown read mode %r' % mode)
+        self.mode = mode
+        self.staleness = staleness
+        self.snapshot_file = snapshot_file
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._pool = None
+        self._inode = None
+        self._thread_pid = None
+        self.refreshes = 0
+        self.last_refresh_ms = None
+
+    def _snapshot_path(self):
+        return self.snapshot_file or db.pool.db_file + '.snapshot'
+
+    def pool(self):
+        if self.mode == 'live':
+            return db.pool
+        if self.mode == 'ro':
+            path, inode = db.pool.db_file, None
+        else:
+            self.ensure_started()
+            path = self._snapshot_path()
+            try:
+                inode = os.stat(path).st_ino
+            except FileNotFoundError:
+                self.refresh()
+                inode = os.stat(path).st_ino
+        pool = self._pool
+        if pool is None or pool.db_file != path or self._inode != inode:
+            with self._lock:
+                if self._pool is None or self._pool.db_file != path or self._inode != inode:
+                    # Connections still out on the replaced file are closed
+                    # once the old pool is garbage collected.
+                    self._pool = db.ConnectionPool(path, read_only=True)
+                    self._inode = inode
+                pool = self._pool
+        return pool
+
+    def refresh(self):
+        """Copy the live database to the snapshot file, then swap it in."""
+        path = self._snapshot_path()
+        tmp = '%s.tmp%d' % (path, os.getpid())
+        with self._refresh_lock:
+            start = time.perf_counter()
+            dest = sqlite3.connect(tmp)
+            try:
+                with db.pool.connection() as live:
+                    db.blocking(live.backup, dest)
+                # mode=ro readers cannot create the -shm file a WAL copy needs.
+                dest.execute('PRAGMA journal_mode=DELETE')
+            finally:
+                dest.close()
+            os.replace(tmp, path)
+            self.last_refresh_ms = round((time.perf_counter() - start) * 1000, 3)
+            self.refreshes += 1
+
+    def ensure_started(self):
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._run, name='read-snapshot', daemon=True).start()
+
+    def _run(self):
+        holder = '%s:%d' % (socket.gethostname(), os.getpid())
+        while True:
+            try:
+                # Refreshing every half bound keeps the snapshot's age under it.
+                with db.pool.connection() as conn:
+                    claimed = partitions.claim_lease(conn, 'read-snapshot', holder, self.staleness / 2)
+                if claimed:
+                    self.refresh()
+            except Exception:
+                log.exception('read snapshot refresh failed')
+            time.sleep(self.staleness / 2)
+
+    def connection(self):
+        return self.pool().connection()
+
+    def stats(self):
+        stats = {'mode': self.mode, 'pool': self.pool().stats()}
+        if self.mode == 'snapshot':
+            stats.update(
+                staleness_bound_s=self.staleness,
+                age_s=round(time.time() - os.stat(self._snapshot_path()).st_mtime, 3),
+                refreshes=self.refreshes,
+                last_refresh_ms=self.last_refresh_ms,
+            )
+        return stats
+
+
+replica = Replica()
+
+
+def get_db():
+    if 'read_db' not in g:
+        pool = replica.pool()
+        g.read_db = (pool, pool.acquire())
+    return g.read_db[1]
+
+
+def close_db(exc=None):
+    entry = g.pop('read_db', None)
+    if entry is not None:
+        entry[0].release(entry[1])
+
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
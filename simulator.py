@@ -0,0 +1,293 @@
+"""Synthetic fleet that drives virtual buses along the stored routes.
+
+Reads the routes (and the registered buses) from a running server and
+drives each virtual bus along its route's stops. Buses pull away from a
+stop, cruise at their own speed with some traffic on each leg, brake into
+the next stop and dwell there. At the end of the line they lay over and
+run the route back. Fixes go out through one of the ingest endpoints:
+
+    http    one POST /update_bus_data per fix
+    batch   JSON arrays of fixes to /update_bus_data/batch
+    binary  packed records (packed.py) to /ingest/binary
+
+Every bus reports once per --interval seconds, so the fleet sends
+buses / interval pings per second. The buses are split across --processes
+worker processes. Each worker spreads its sends evenly over the interval
+instead of bursting them all at the start of a tick.
+
+    python simulator.py --url http://127.0.0.1:8000 --buses 50000 \\
+        --interval 1 --mode binary --processes 8
+"""
+import argparse
+import http.client
+import json
+import math
+import multiprocessing
+import random
+import sys
+import time
+from urllib.parse import urlsplit
+
+import geometry
+import packed
+
+MODES = ('http', 'batch', 'binary')
+ACCEL = 1.0
+DECEL = 1.3
+# Keeps a braking bus creeping forward so it actually reaches the stop.
+CREEP = 1.0
+MAX_STEP_S = 1.0
+
+
+class VirtualBus:
+    __slots__ = ('bus_no', 'shape', 'rng', 'cruise', 'dwell_range', 'layover',
+                 'stop', 'direction', 'along', 'speed', 'traffic', 'dwell',
+                 'air_quality', 'passengers')
+
+    def __init__(self, bus_no, shape, rng, dwell_range, layover):
+        self.bus_no = bus_no
+        self.shape = shape
+        self.rng = rng
+        self.cruise = min(16.0, max(4.0, rng.gauss(9.0, 2.0)))
+        self.dwell_range = dwell_range
+        self.layover = layover
+        self.air_quality = rng.randint(30, 120)
+        self.passengers = rng.randint(0, 40)
+        self.speed = 0.0
+        self.dwell = 0.0
+        last = len(shape.cumulative) - 1
+        if last == 0:
+            self.stop, self.direction, self.along = 0, 1, 0.0
+            return
+        # Start somewhere along a random leg, heading either way.
+        self.direction = rng.choice((1, -1))
+        self.stop = rng.randint(0, last - 1) if self.direction == 1 else rng.randint(1, last)
+        start, end = shape.cumulative[self.stop], shape.cumulative[self.stop + self.direction]
+        self.along = start + rng.random() * (end - start)
+        self.traffic = rng.uniform(0.6, 1.1)
+
+    def advance(self, dt):
+        cumulative = self.shape.cumulative
+        if len(cumulative) < 2:
+            return
+        while dt > 0:
+            if self.dwell > 0:
+                used = min(dt, self.dwell)
+                self.dwell -= used
+                dt -= used
+                continue
+            step = min(dt, MAX_STEP_S)
+            dt -= step
+            remaining = abs(cumulative[self.stop + self.direction] - self.along)
+            self.speed = min(self.speed + ACCEL * step, self.cruise * self.traffic,
+                             max(math.sqrt(2 * DECEL * remaining), CREEP))
+            move = self.speed * step
+            if move >= remaining:
+                self._arrive()
+            else:
+                self.along += move * self.direction
+
+    def _arrive(self):
+        cumulative = self.shape.cumulative
+        self.stop += self.direction
+        self.along = cumulative[self.stop]
+        self.speed = 0.0
+        self.passengers = min(80, max(0, self.passengers + self.rng.randint(-8, 10)))
+        if self.stop in (0, len(cumulative) - 1):
+            self.direction = -self.direction
+            self.dwell = self.layover
+            self.passengers = 0
+        else:
+            self.dwell = self.rng.uniform(*self.dwell_range)
+        self.traffic = self.rng.uniform(0.6, 1.1)
+
+    def fix(self, now):
+        lat, lng, _ = self.shape.point_at(self.along)
+        self.air_quality = min(300, max(0, self.air_quality + self.rng.randint(-2, 2)))
+        return (self.bus_no, round(lat, 6), round(lng, 6), self.air_quality, self.passengers, now)
+
+
+class Emitter:
+    """Sends fixes over one keep-alive connection in the chosen ingest format."""
+
+    def __init__(self, url, mode):
+        parts = urlsplit(url)
+        connection = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.conn = connection(parts.hostname, parts.port, timeout=30)
+        self.prefix = parts.path.rstrip('/')
+        self.mode = mode
+
+    def _post(self, path, body, content_type):
+        try:
+            self.conn.request('POST', self.prefix + path, body, {'Content-Type': content_type})
+            response = self.conn.getresponse()
+            response.read()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            return False
+        if response.getheader('Connection', '').lower() == 'close':
+            self.conn.close()
+        return response.status < 400
+
+    def send(self, fixes):
+        """Returns how many fixes the server accepted."""
+        if self.mode == 'http':
+            ok = 0
+            for bus_no, lat, lng, aqi, passengers, _ in fixes:
+                ok += self._post('/update_bus_data', json.dumps({
+                    'bus_no': bus_no, 'latitude': lat, 'longitude': lng,
+                    'air_quality': aqi, 'passenger_count': passengers,
+                }), 'application/json')
+            return ok
+        if self.mode == 'batch':
+            body = json.dumps([{
+                'bus_no': bus_no, 'latitude': lat, 'longitude': lng, 'air_quality': aqi,
+                'passenger_count': passengers, 'timestamp': now,
+            } for bus_no, lat, lng, aqi, passengers, now in fixes])
+            return len(fixes) if self._post('/update_bus_data/batch', body, 'application/json') else 0
+        body = b''.join(packed.encode(bus_no, lat, lng, aqi, passengers, now)
+                        for bus_no, lat, lng, aqi, passengers, now in fixes)
+        return len(fixes) if self._post('/ingest/binary', body, 'application/octet-stream') else 0
+
+
+def fetch(url, path):
+    parts = urlsplit(url)
+    connection = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    conn = connection(parts.hostname, parts.port, timeout=30)
+    try:
+        conn.request('GET', parts.path.rstrip('/') + path)
+        response = conn.getresponse()
+        if response.status != 200:
+            raise RuntimeError('GET %s returned %d' % (path, response.status))
+        return json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def plan_fleet(routes, registered, count, seed):
+    """[(bus_no, route_no)]: registered buses first, then SIM-nnnnn ones."""
+    buses = [(b['bus_no'], b['route_no']) for b in registered if b['route_no'] in routes]
+    if count is None:
+        return buses
+    buses = buses[:count]
+    route_nos = sorted(routes)
+    rng = random.Random(seed)
+    for n in range(count - len(buses)):
+        buses.append(('SIM-%05d' % (n + 1), rng.choice(route_nos)))
+    return buses
+
+
+def worker(index, args, paths, buses, counters, stop):
+    rng = random.Random('%s-%d' % (args.seed, index))
+    shapes = {route_no: geometry.RouteGeometry.from_path(0, route_no, path)
+              for route_no, path in paths.items()}
+    fleet = [VirtualBus(bus_no, shapes[route_no], rng, args.dwell, args.layover)
+             for bus_no, route_no in buses]
+    groups = [fleet[i:i + args.batch_size] for i in range(0, len(fleet), args.batch_size)]
+    emitter = Emitter(args.url, args.mode)
+    dt = args.interval * args.speedup
+    slot = index * 3
+
+    tick = time.monotonic()
+    while not stop.is_set() and groups:
+        for g, group in enumerate(groups):
+            due = tick + g * args.interval / len(groups)
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -args.interval:
+                counters[slot + 2] += 1
+            now = time.time()
+            fixes = []
+            for bus in group:
+                bus.advance(dt)
+                fixes.append(bus.fix(now))
+            accepted = emitter.send(fixes)
+            counters[slot] += accepted
+            counters[slot + 1] += len(fixes) - accepted
+            if stop.is_set():
+                break
+        tick += args.interval
+
+
+def dwell_range(value):
+    low, _, high = value.partition(',')
+    return float(low), float(high or low)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--mode', choices=MODES, default='batch')
+    parser.add_argument('--buses', type=int,
+                        help='total virtual buses; default: one per registered bus')
+    parser.add_argument('--register', action='store_true',
+                        help='register the SIM-nnnnn buses so route-aware features see them')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between fixes per bus')
+    parser.add_argument('--speedup', type=float, default=1.0,
+                        help='simulated seconds per wall-clock second')
+    parser.add_argument('--dwell', type=dwell_range, default=(10.0, 45.0),
+                        help='seconds at an intermediate stop, as min,max')
+    parser.add_argument('--layover', type=float, default=180.0,
+                        help='seconds at the end of the line')
+    parser.add_argument('--batch-size', type=int, default=500, help='fixes per request or send')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--duration', type=float, help='seconds to run; default until interrupted')
+    parser.add_argument('--report', type=float, default=5.0, help='seconds between progress lines')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    paths = {}
+    for route in fetch(args.url, '/get_routes'):
+        try:
+            geometry.RouteGeometry.from_path(0, route['route_no'], route['path'])
+        except (ValueError, KeyError, TypeError):
+            print('skipping route %s: unusable path' % route['route_no'], file=sys.stderr)
+            continue
+        paths[route['route_no']] = route['path']
+    if not paths:
+        sys.exit('no routes with usable paths at %s' % args.url)
+
+    buses = plan_fleet(paths, fetch(args.url, '/get_buses'), args.buses, args.seed)
+    if not buses:
+        sys.exit('no buses to simulate; pass --buses')
+    if args.register:
+        registrar = Emitter(args.url, 'http')
+        for bus_no, route_no in buses:
+            if bus_no.startswith('SIM-'):
+                registrar._post('/add_bus', json.dumps({'bus_no': bus_no, 'route_no': route_no}),
+                                'application/json')
+
+    processes = max(1, min(args.processes, len(buses)))
+    counters = multiprocessing.Array('d', processes * 3, lock=False)
+    stop = multiprocessing.Event()
+    workers = [multiprocessing.Process(
+        target=worker, args=(i, args, paths, buses[i::processes], counters, stop), daemon=True)
+        for i in range(processes)]
+    for w in workers:
+        w.start()
+    print('%d buses on %d routes, %d processes, %s mode: target %.0f pings/s' % (
+        len(buses), len(paths), processes, args.mode, len(buses) / args.interval))
+
+    start = last_time = time.monotonic()
+    last_sent = 0.0
+    try:
+        while args.duration is None or time.monotonic() - start < args.duration:
+            time.sleep(args.report if args.duration is None
+                       else max(0.0, min(args.report, args.duration - (time.monotonic() - start))))
+            now = time.monotonic()
+            sent = sum(counters[0::3])
+            print('%8.1fs  %9.0f pings/s  sent %d  failed %d  late sends %d' % (
+                now - start, (sent - last_sent) / (now - last_time), sent,
+                sum(counters[1::3]), sum(counters[2::3])))
+            last_sent, last_time = sent, now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        for w in workers:
+            w.join(5)
+
+
+if __name__ == '__main__':
+    main()
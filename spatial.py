@@ -0,0 +1,143 @@
+import math
+import os
+import threading
+
+import geometry
+import latest
+from geometry import METERS_PER_DEGREE_LAT, METERS_PER_DEGREE_LNG, haversine
+
+# Grid cell edge in degrees; 0.005 is roughly 550 m of latitude.
+CELL_DEG = float(os.environ.get('SMARTBUS_GRID_CELL_DEG', '0.005'))
+MAX_RADIUS_M = 5000
+
+
+def cell_of(lat, lng, cell=CELL_DEG):
+    return int(math.floor(lat / cell)), int(math.floor(lng / cell))
+
+
+def cells_around(lat, lng, radius_m, cell=CELL_DEG):
+    dlat = radius_m / METERS_PER_DEGREE_LAT
+    dlng = radius_m / (METERS_PER_DEGREE_LNG * max(math.cos(math.radians(lat)), 0.01))
+    lat0, lng0 = cell_of(lat - dlat, lng - dlng, cell)
+    lat1, lng1 = cell_of(lat + dlat, lng + dlng, cell)
+    for i in range(lat0, lat1 + 1):
+        for j in range(lng0, lng1 + 1):
+            yield i, j
+
+
+class GridIndex:
+    """Uniform lat/lng grid of keyed points with incremental updates."""
+
+    def __init__(self, cell=CELL_DEG):
+        self.cell = cell
+        self._cells = {}
+        self._where = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._where)
+
+    def update(self, key, lat, lng, value=None):
+        cell = cell_of(lat, lng, self.cell)
+        with self._lock:
+            old = self._where.get(key)
+            if old is not None and old != cell:
+                bucket = self._cells[old]
+                del bucket[key]
+                if not bucket:
+                    del self._cells[old]
+            self._cells.setdefault(cell, {})[key] = (lat, lng, value)
+            self._where[key] = cell
+
+    def remove(self, key):
+        with self._lock:
+            cell = self._where.pop(key, None)
+            if cell is not None:
+                bucket = self._cells[cell]
+                del bucket[key]
+                if not bucket:
+                    del self._cells[cell]
+
+    def clear(self):
+        with self._lock:
+            self._cells = {}
+            self._where = {}
+
+    def near(self, lat, lng, radius_m, limit=None):
+        """[(distance_m, key, lat, lng, value)] within radius, nearest first."""
+        found = []
+        with self._lock:
+            for cell in cells_around(lat, lng, radius_m, self.cell):
+                bucket = self._cells.get(cell)
+                if not bucket:
+                    continue
+                for key, (plat, plng, value) in bucket.items():
+                    d = haversine(lat, lng, plat, plng)
+                    if d <= radius_m:
+                        found.append((d, key, plat, plng, value))
+        found.sort(key=lambda f: f[0])
+        return found[:limit] if limit else found
+
+
+class BusIndex:
+    """Latest bus positions, kept current by the latest-state store."""
+
+    def __init__(self, store):
+        self.store = store
+        self.grid = GridIndex()
+        self._pid = None
+        self._lock = threading.Lock()
+        store.add_listener(self._on_change)
+
+    def _on_change(self, state):
+        self.grid.update(state.bus_no, state.latitude, state.longitude)
+
+    def _ensure_built(self):
+        # A worker warms the store without notifications, so seed the grid
+        # once from a snapshot; the listener keeps it current after that.
+        self.store.sync()
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.grid.clear()
+            for state in self.store.all():
+                self.grid.update(state.bus_no, state.latitude, state.longitude)
+            self._pid = os.getpid()
+
+    def near(self, lat, lng, radius_m, limit=None):
+        self._ensure_built()
+        return self.grid.near(lat, lng, radius_m, limit)
+
+
+class StopIndex:
+    """Every stop of every route, rebuilt when the route cache changes."""
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.grid = GridIndex()
+        self._built_version = None
+        self._lock = threading.Lock()
+
+    def _ensure_built(self):
+        self.routes.load()
+        if self._built_version == self.routes.version:
+            return
+        with self._lock:
+            if self._built_version == self.routes.version:
+                return
+            grid = GridIndex()
+            for route in self.routes.all():
+                for i, name in enumerate(route.names):
+                    grid.update((route.route_no, i), route.lats[i], route.lngs[i], name)
+            self.grid = grid
+            self._built_version = self.routes.version
+
+    def near(self, lat, lng, radius_m, limit=None):
+        self._ensure_built()
+        return self.grid.near(lat, lng, radius_m, limit)
+
+
+buses = BusIndex(latest.store)
+stops = StopIndex(geometry.routes)
@@ -60,8 +60,33 @@ map.on("click", function (e) {
     .openPopup();
 
   alert("✅ Alert set at:\nLat: " + alertLocation[0].toFixed(5) + "\nLng: " + alertLocation[1].toFixed(5));
+  watchAlertLocation();
 });
 
+// 🔔 Server-side proximity alert for the selected bus
+const ALERT_RADIUS_M = 300;
+let alertStream = null;
+function watchAlertLocation() {
+  const selectedBus = localStorage.getItem("selectedBus");
+
+  if (!selectedBus || !alertLocation) return;
+
+  if (alertStream) alertStream.close();
+  const params = new URLSearchParams({
+    bus_no: selectedBus,
+    lat: alertLocation[0],
+    lng: alertLocation[1],
+    radius: ALERT_RADIUS_M
+  });
+  alertStream = new EventSource(`/stream/alerts?${params}`);
+
+  alertStream.addEventListener("alert", (event) => {
+    const data = JSON.parse(event.data);
+    alertMarker.bindPopup(`🚌 ${data.bus_no} is ${Math.round(data.distance_m)} m away`).openPopup();
+    alert(`🔔 Bus ${data.bus_no} is near your alert location`);
+  });
+}
+
 // 🔁 Load Route Dropdown Options
 function populateRouteDropdown() {
   fetch('/get_routes')
@@ -96,34 +121,40 @@ window.onload = () => {
   if (document.getElementById("route_no")) populateRouteDropdown();
 };
 
-// 🔁 Periodically fetch and update bus location
-setInterval(() => {
+// 🔁 Live bus location pushed from the server
+let busStream = null;
+function followSelectedBus() {
   const selectedBus = localStorage.getItem("selectedBus");
 
   if (!selectedBus) return;
 
-  fetch(`/get_bus_location/${selectedBus}`)
-    .then(res => res.json())
-    .then(data => {
-      if (data.latitude && data.longitude) {
-        const lat = data.latitude;
-        const lng = data.longitude;
+  if (busStream) busStream.close();
+  busStream = new EventSource(`/stream/bus/${encodeURIComponent(selectedBus)}`);
 
-        // ✅ Update marker position
-        busMarker.setLatLng([lat, lng]);
+  busStream.addEventListener("position", (event) => {
+    const data = JSON.parse(event.data);
+    if (data.latitude && data.longitude) {
+      const lat = data.latitude;
+      const lng = data.longitude;
 
-        // ✅ Re-center map to bus location
-        map.setView([lat, lng]);
+      // ✅ Update marker position
+      busMarker.setLatLng([lat, lng]);
 
-        console.log(`🚌 ${selectedBus} → ${lat}, ${lng}`);
-      } else {
-        console.warn("⚠️ No location found for", selectedBus);
-      }
-    })
-    .catch(err => {
-      console.error("❌ Error fetching bus location:", err);
-    });
-}, 5000); // 🔁 Every 5 seconds
+      // ✅ Re-center map to bus location
+      map.setView([lat, lng]);
+
+      console.log(`🚌 ${selectedBus} → ${lat}, ${lng}`);
+    } else {
+      console.warn("⚠️ No location found for", selectedBus);
+    }
+  });
+
+  busStream.onerror = (err) => {
+    // EventSource reconnects on its own after the server's retry interval
+    console.error("❌ Bus location stream interrupted:", err);
+  };
+}
+followSelectedBus();
 
 
 // 🚀 Ready for extension: You can add periodic bus location updates, alert triggering, etc.
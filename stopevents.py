@@ -0,0 +1,278 @@
+"""Stop arrival and departure events, derived incrementally from gps_data.
+
+One worker at a time (the 'stop-events' lease) tails gps_data past a stored
+cursor. It keeps, per bus, the stop the bus is currently at, so each fix
+costs one small grid lookup. A fix within RADIUS_M of a stop on the bus's
+route is an arrival. The first fix outside EXIT_RADIUS_M of that stop is
+the departure. The wider exit circle keeps GPS jitter at the edge from
+flapping. Events and the cursor commit together.
+
+Tailing the stored history rather than each worker's ingest queue keeps a
+bus's fixes in one place even when gunicorn spreads them over workers.
+Replayed fixes can be stored after newer ones. Each batch is taken in
+timestamp order, and a fix older than the last one used for its bus is
+skipped, so a bus never runs backwards through its stops.
+Stationary suppression stores a fix as soon as a bus moves
+ingest.STATIONARY_M, so departures lag by at most the time to cover the
+exit radius.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+
+import db
+import fleet
+import geometry
+import ingest
+import partitions
+import spatial
+
+log = logging.getLogger(__name__)
+
+RADIUS_M = float(os.environ.get('SMARTBUS_STOP_RADIUS_M', '30'))
+EXIT_RADIUS_M = float(os.environ.get('SMARTBUS_STOP_EXIT_RADIUS_M', str(RADIUS_M * 1.5)))
+# A bus silent for longer than this at a stop departed at its last fix there.
+MAX_GAP_S = float(os.environ.get('SMARTBUS_STOP_MAX_GAP_S', '600'))
+INTERVAL = float(os.environ.get('SMARTBUS_STOP_EVENTS_INTERVAL', '1'))
+BATCH = 5000
+MAX_LIMIT = 1000
+
+ARRIVAL = 'arrival'
+DEPARTURE = 'departure'
+
+
+class Visit:
+    __slots__ = ('route_no', 'stop_index', 'lat', 'lng', 'arrived', 'last_seen', 'last_timestamp')
+
+    def __init__(self, route_no, stop_index, lat, lng, arrived, timestamp):
+        self.route_no = route_no
+        self.stop_index = stop_index
+        self.lat = lat
+        self.lng = lng
+        self.arrived = arrived
+        self.last_seen = arrived
+        self.last_timestamp = timestamp
+
+
+class Detector:
+    """Which stop each bus is at; feed() turns a fix into zero to two events.
+
+    Events are (bus_no, route_no, stop_index, event, timestamp, dwell_s).
+    """
+
+    def __init__(self, stops=None, radius_m=RADIUS_M, exit_radius_m=EXIT_RADIUS_M,
+                 max_gap=MAX_GAP_S):
+        self.stops = stops or spatial.stops
+        self.radius_m = radius_m
+        self.exit_radius_m = max(exit_radius_m, radius_m)
+        self.max_gap = max_gap
+        self._at = {}
+        # bus_no -> timestamp of the newest fix fed, to drop late replays.
+        self._last = {}
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self._at)
+
+    def restore(self, bus_no, route_no, stop_index, timestamp, event=ARRIVAL):
+        self._last[bus_no] = max(self._last.get(bus_no, timestamp), timestamp)
+        if event != ARRIVAL:
+            return
+        route = geometry.routes.get(route_no)
+        if route is None or stop_index >= len(route.names):
+            return
+        self._at[bus_no] = Visit(route_no, stop_index, route.lats[stop_index],
+                                 route.lngs[stop_index], ingest.to_epoch(timestamp), timestamp)
+
+    def feed(self, bus_no, route_no, lat, lng, timestamp):
+        last = self._last.get(bus_no)
+        if last is not None and timestamp < last:
+            self.skipped += 1
+            return []
+        self._last[bus_no] = timestamp
+        events = []
+        visit = self._at.get(bus_no)
+        if visit is not None:
+            t = ingest.to_epoch(timestamp)
+            if t - visit.last_seen > self.max_gap:
+                # Silent too long to have stayed put: it left after its last fix.
+                events.append((bus_no, visit.route_no, visit.stop_index, DEPARTURE,
+                               visit.last_timestamp, round(visit.last_seen - visit.arrived, 3)))
+                del self._at[bus_no]
+            elif visit.route_no == route_no and geometry.haversine(
+                    lat, lng, visit.lat, visit.lng) <= self.exit_radius_m:
+                visit.last_seen = max(visit.last_seen, t)
+                visit.last_timestamp = max(visit.last_timestamp, timestamp)
+                return events
+            else:
+                events.append((bus_no, visit.route_no, visit.stop_index, DEPARTURE, timestamp,
+                               round(max(t - visit.arrived, 0.0), 3)))
+                del self._at[bus_no]
+
+        if route_no is None:
+            return events
+        for _, (stop_route, stop_index), stop_lat, stop_lng, _ in self.stops.near(lat, lng, self.radius_m):
+            if stop_route == route_no:
+                self._at[bus_no] = Visit(route_no, stop_index, stop_lat, stop_lng,
+                                         ingest.to_epoch(timestamp), timestamp)
+                events.append((bus_no, route_no, stop_index, ARRIVAL, timestamp, None))
+                break
+        return events
+
+
+def restore(conn, detector):
+    """Seed a detector with each bus's last event; an arrival puts it at that stop."""
+    rows = conn.execute('''
+        SELECT bus_no, route_no, stop_index, event, timestamp FROM stop_events
+        WHERE id IN (SELECT MAX(id) FROM stop_events GROUP BY bus_no)
+    ''').fetchall()
+    for bus_no, route_no, stop_index, event, timestamp in rows:
+        detector.restore(bus_no, route_no, stop_index, timestamp, event)
+
+
+class Processor:
+    """Background thread in every worker; the lease lets only one do the work."""
+
+    def __init__(self, interval=INTERVAL, batch=BATCH):
+        self.interval = interval
+        self.batch = batch
+        self.holder = '%s:%d' % (socket.gethostname(), os.getpid())
+        self._lock = threading.Lock()
+        self._pid = None
+        self.detector = None
+        self.fixes = 0
+        self.events = 0
+        self.last_id = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid() or self.interval <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.holder = '%s:%d' % (socket.gethostname(), self._pid)
+            self.detector = None
+            threading.Thread(target=self._run, name='stop-events', daemon=True).start()
+
+    def run_once(self):
+        """Process one batch of new fixes; returns how many were read."""
+        with db.pool.connection() as conn:
+            if not partitions.claim_lease(conn, 'stop-events', self.holder,
+                                          max(self.interval * 10, 30)):
+                # Another worker owns the stream; our state would go stale.
+                self.detector = None
+                return 0
+            if self.detector is None:
+                detector = Detector()
+                restore(conn, detector)
+                self.detector = detector
+            last_id = conn.execute('SELECT last_id FROM stop_events_cursor').fetchone()[0]
+            rows = conn.execute('''
+                SELECT id, bus_no, latitude, longitude, timestamp FROM gps_data
+                WHERE id > ? ORDER BY id LIMIT ?
+            ''', (last_id, self.batch)).fetchall()
+            if not rows:
+                self.last_id = last_id
+                return 0
+
+            events = []
+            # Stable, so fixes with equal timestamps keep their id order.
+            for _, bus_no, lat, lng, timestamp in sorted(rows, key=lambda row: row[4]):
+                events.extend(self.detector.feed(
+                    bus_no, fleet.assignments.route_of(bus_no), lat, lng, timestamp))
+
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                moved = conn.execute('UPDATE stop_events_cursor SET last_id = ? WHERE last_id = ?',
+                                     (rows[-1][0], last_id)).rowcount
+                if not moved:
+                    # Someone else advanced the cursor: our state is behind it.
+                    conn.rollback()
+                    self.detector = None
+                    return 0
+                conn.executemany('''
+                    INSERT INTO stop_events (bus_no, route_no, stop_index, event, timestamp, dwell_s)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', events)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                self.detector = None
+                raise
+        self.fixes += len(rows)
+        self.events += len(events)
+        self.last_id = rows[-1][0]
+        return len(rows)
+
+    def _run(self):
+        while True:
+            try:
+                read = self.run_once()
+            except Exception:
+                log.exception('stop event processing failed')
+                read = 0
+            if read < self.batch:
+                time.sleep(self.interval)
+
+    def stats(self):
+        detector = self.detector
+        return {
+            'holder': self.holder,
+            'active': detector is not None,
+            'buses_at_stops': len(detector) if detector is not None else None,
+            'skipped': detector.skipped if detector is not None else None,
+            'last_id': self.last_id,
+            'fixes': self.fixes,
+            'events': self.events,
+        }
+
+
+def events(conn, route_no, stop_index=None, bus_no=None, start=None, end=None, limit=100):
+    """Events on a route, newest first, optionally for one stop or bus."""
+    clauses, params = ['route_no = ?'], [route_no]
+    if stop_index is not None:
+        clauses.append('stop_index = ?')
+        params.append(stop_index)
+    if bus_no is not None:
+        clauses.append('bus_no = ?')
+        params.append(bus_no)
+    if start is not None:
+        clauses.append('timestamp >= ?')
+        params.append(start)
+    if end is not None:
+        clauses.append('timestamp < ?')
+        params.append(end)
+    rows = conn.execute('''
+        SELECT bus_no, route_no, stop_index, event, timestamp, dwell_s FROM stop_events
+        WHERE %s ORDER BY timestamp DESC, id DESC LIMIT ?
+    ''' % ' AND '.join(clauses), params + [limit]).fetchall()
+    return [{'bus_no': r[0], 'route_no': r[1], 'stop_index': r[2], 'event': r[3],
+             'timestamp': r[4], 'dwell_s': r[5]} for r in rows]
+
+
+def headways(conn, route_no, stop_index, start=None, end=None, limit=100):
+    """Arrivals at one stop, oldest first, each with the gap since the one before."""
+    clauses, params = ['route_no = ?', 'stop_index = ?', 'event = ?'], [route_no, stop_index, ARRIVAL]
+    if start is not None:
+        clauses.append('timestamp >= ?')
+        params.append(start)
+    if end is not None:
+        clauses.append('timestamp < ?')
+        params.append(end)
+    rows = conn.execute('''
+        SELECT bus_no, timestamp FROM stop_events
+        WHERE %s ORDER BY timestamp DESC LIMIT ?
+    ''' % ' AND '.join(clauses), params + [limit]).fetchall()
+    arrivals, previous = [], None
+    for bus_no, timestamp in reversed(rows):
+        t = ingest.to_epoch(timestamp)
+        arrivals.append({'bus_no': bus_no, 'timestamp': timestamp,
+                         'headway_s': None if previous is None else round(t - previous, 3)})
+        previous = t
+    return arrivals
+
+
+processor = Processor()
@@ -0,0 +1,321 @@
+"""Storage backends behind the route, bus and telemetry stores.
+
+SMARTBUS_STORAGE picks the backend: 'sqlite' (the default, routes.db) or
+'postgres' (pgstore.py, needs psycopg). Handlers and caches go through the
+module-level ``routes``, ``buses`` and ``telemetry`` objects, including
+the bus listing and history reads. Export, compaction and stop events
+still work on SQLite's per-day partitions and only run on that backend.
+"""
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import db
+import migrations
+import partitions
+import replica
+
+BACKEND = os.environ.get('SMARTBUS_STORAGE', 'sqlite')
+
+NOT_SNAPPED = (None, None, None, None)
+FETCH_SIZE = 1000
+
+
+class Conflict(Exception):
+    """A route or bus with that number already exists."""
+
+
+class RouteStore(abc.ABC):
+    @abc.abstractmethod
+    def add(self, route_no, path):
+        pass
+
+    @abc.abstractmethod
+    def all(self):
+        """[(id, route_no, path)] in id order."""
+
+
+class BusStore(abc.ABC):
+    @abc.abstractmethod
+    def add(self, bus_no, route_no):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, bus_id):
+        pass
+
+    @abc.abstractmethod
+    def all(self):
+        """[(id, bus_no, route_no)] in id order."""
+
+    @abc.abstractmethod
+    def fingerprint(self):
+        """A value that changes whenever a bus or route is added or deleted."""
+
+    @abc.abstractmethod
+    def search(self, q=None, page=1, per_page=50):
+        """(total, rows) of buses with their routes, ordered by route_no then
+        bus_no. q matches bus_no, route_no or a stop name, case-insensitively."""
+
+
+class TelemetryStore(abc.ABC):
+    @abc.abstractmethod
+    def write(self, pings, heartbeats=()):
+        """Store pings and refresh last_seen for heartbeats, in one transaction."""
+
+    @abc.abstractmethod
+    def latest(self):
+        """(rows of bus_no, latitude, longitude, timestamp, air_quality,
+        passenger_count; highest history id)."""
+
+    def stats(self):
+        return {}
+
+    @abc.abstractmethod
+    def since(self, last_id):
+        """[(id, bus_no, latitude, longitude, timestamp, air_quality,
+        passenger_count)] for history rows past last_id, in id order."""
+
+    @abc.abstractmethod
+    def fixes(self, bus_no, start, end):
+        """Yield (timestamp, latitude, longitude) for a bus in time order."""
+
+
+def stop_names(path):
+    """The stop names in a route's path JSON; [] when it isn't a list of stops."""
+    try:
+        stops = json.loads(path)
+    except (TypeError, ValueError):
+        return []
+    if not isinstance(stops, list):
+        return []
+    return [s.get('name') if isinstance(s, dict) else None for s in stops]
+
+
+def listing_row(bus_id, bus_no, route_no, route_id, stops):
+    return {'bus_id': bus_id, 'bus_no': bus_no, 'route_no': route_no,
+            'route_id': route_id, 'stops': stops}
+
+
+def like_pattern(q):
+    # Match q literally: its own % and _ are not wildcards.
+    return '%%%s%%' % q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class SQLiteRouteStore(RouteStore):
+    def add(self, route_no, path):
+        with db.pool.connection() as conn:
+            try:
+                conn.execute('INSERT INTO routes (route_no, path) VALUES (?, ?)', (route_no, path))
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                raise Conflict(route_no)
+            conn.commit()
+
+    def all(self):
+        with db.pool.connection() as conn:
+            return conn.execute('SELECT id, route_no, path FROM routes ORDER BY id').fetchall()
+
+
+class SQLiteBusStore(BusStore):
+    SEARCH = '''
+        FROM buses b JOIN routes r ON r.route_no = b.route_no
+        WHERE (:q IS NULL
+               OR b.bus_no LIKE :q ESCAPE '\\'
+               OR b.route_no LIKE :q ESCAPE '\\'
+               OR CASE WHEN json_valid(r.path) THEN EXISTS (
+                      SELECT 1 FROM json_each(r.path)
+                      -- CASE, not AND: SQLite may evaluate AND's terms in any order.
+                      WHERE CASE WHEN json_each.type = 'object'
+                            THEN json_extract(json_each.value, '$.name') END LIKE :q ESCAPE '\\')
+                  ELSE 0 END)
+    '''
+
+    def add(self, bus_no, route_no):
+        with db.pool.connection() as conn:
+            try:
+                conn.execute('INSERT INTO buses (bus_no, route_no) VALUES (?, ?)', (bus_no, route_no))
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                raise Conflict(bus_no)
+            conn.commit()
+
+    def delete(self, bus_id):
+        with db.pool.connection() as conn:
+            conn.execute('DELETE FROM buses WHERE id = ?', (bus_id,))
+            conn.commit()
+
+    def all(self):
+        with db.pool.connection() as conn:
+            return conn.execute('SELECT id, bus_no, route_no FROM buses ORDER BY id').fetchall()
+
+    def fingerprint(self):
+        # Changes whenever a bus or route is added or deleted, in any worker.
+        with replica.replica.connection() as conn:
+            return conn.execute('''
+                SELECT (SELECT COUNT(*) FROM buses), (SELECT MAX(id) FROM buses),
+                       (SELECT COUNT(*) FROM routes), (SELECT MAX(id) FROM routes)
+            ''').fetchone()
+
+    def search(self, q=None, page=1, per_page=50):
+        params = {'q': like_pattern(q) if q else None}
+        with replica.replica.connection() as conn:
+            total = conn.execute('SELECT COUNT(*) ' + self.SEARCH, params).fetchone()[0]
+            params.update(limit=per_page, offset=(page - 1) * per_page)
+            rows = conn.execute('''
+                SELECT b.id, b.bus_no, b.route_no, r.id,
+                       CASE WHEN json_valid(r.path) THEN (
+                           -- Entries that aren't objects have no name to extract.
+                           SELECT json_group_array(CASE WHEN json_each.type = 'object'
+                                                   THEN json_extract(json_each.value, '$.name') END)
+                           FROM json_each(r.path)) END
+            ''' + self.SEARCH + ' ORDER BY b.route_no, b.bus_no LIMIT :limit OFFSET :offset',
+                params).fetchall()
+        return total, [listing_row(bus_id, bus_no, route_no, route_id,
+                                   json.loads(stops) if stops else [])
+                       for bus_id, bus_no, route_no, route_id, stops in rows]
+
+
+class SQLiteTelemetryStore(TelemetryStore):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.lock_wait = 0.0
+        self.max_lock_wait = 0.0
+
+    def write(self, pings, heartbeats=()):
+        with db.pool.connection() as conn:
+            # Time spent waiting for the write lock, which readers on the
+            # same file can stretch.
+            start = time.perf_counter()
+            conn.execute('BEGIN IMMEDIATE')
+            waited = time.perf_counter() - start
+            with self._lock:
+                self.writes += 1
+                self.lock_wait += waited
+                self.max_lock_wait = max(self.max_lock_wait, waited)
+            try:
+                self._write(conn, pings, heartbeats)
+            except Exception:
+                conn.rollback()
+                # Partitions created in the rolled back transaction are gone.
+                partitions.partitions.forget()
+                raise
+
+    def _write(self, conn, pings, heartbeats):
+        partitions.partitions.insert(
+            conn, [(p.bus_no, p.latitude, p.longitude, p.timestamp) + (p.snap or NOT_SNAPPED)
+                   for p in pings])
+
+        # Only the newest ping per bus matters for the upserts. Replayed fixes
+        # can be older than what is already stored, so bus_status is guarded
+        # against bus_latest before bus_latest itself moves.
+        latest = {}
+        for p in pings:
+            newest = latest.get(p.bus_no)
+            if newest is None or p.timestamp >= newest.timestamp:
+                latest[p.bus_no] = p
+        conn.executemany('''
+            INSERT INTO bus_status (bus_no, air_quality, passenger_count)
+            VALUES (?, ?, ?)
+            ON CONFLICT(bus_no) DO UPDATE SET
+            air_quality = excluded.air_quality,
+            passenger_count = excluded.passenger_count
+            WHERE NOT EXISTS (
+                SELECT 1 FROM bus_latest l WHERE l.bus_no = excluded.bus_no AND l.timestamp > ?)
+        ''', [(p.bus_no, p.air_quality, p.passenger_count, p.timestamp) for p in latest.values()])
+        conn.executemany('''
+            INSERT INTO bus_latest
+                (bus_no, latitude, longitude, timestamp, air_quality, passenger_count, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(bus_no) DO UPDATE SET
+            latitude = excluded.latitude,
+            longitude = excluded.longitude,
+            timestamp = excluded.timestamp,
+            air_quality = excluded.air_quality,
+            passenger_count = excluded.passenger_count,
+            last_seen = MAX(excluded.last_seen, COALESCE(bus_latest.last_seen, ''))
+            WHERE excluded.timestamp >= bus_latest.timestamp
+        ''', [(p.bus_no, p.latitude, p.longitude, p.timestamp, p.air_quality, p.passenger_count,
+               p.timestamp) for p in latest.values()])
+        if heartbeats:
+            conn.executemany(
+                "UPDATE bus_latest SET last_seen = MAX(?, COALESCE(last_seen, '')) WHERE bus_no = ?",
+                [(p.timestamp, p.bus_no) for p in heartbeats])
+        conn.commit()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'writes': self.writes,
+                'lock_wait_ms': round(self.lock_wait * 1000, 3),
+                'max_lock_wait_ms': round(self.max_lock_wait * 1000, 3),
+            }
+
+    def latest(self):
+        with db.pool.connection() as conn:
+            # One read transaction, so no batch lands between the two reads.
+            conn.execute('BEGIN')
+            try:
+                rows = conn.execute('''
+                    SELECT bus_no, latitude, longitude, timestamp, air_quality, passenger_count
+                    FROM bus_latest
+                ''').fetchall()
+                last_id = conn.execute('SELECT last_id FROM gps_sequence').fetchone()[0]
+            finally:
+                conn.rollback()
+        return rows, last_id
+
+    def since(self, last_id):
+        with db.pool.connection() as conn:
+            return conn.execute('''
+                SELECT g.id, g.bus_no, g.latitude, g.longitude, g.timestamp,
+                       s.air_quality, s.passenger_count
+                FROM gps_data g LEFT JOIN bus_status s ON s.bus_no = g.bus_no
+                WHERE g.id > ?
+                ORDER BY g.id
+            ''', (last_id,)).fetchall()
+
+    def fixes(self, bus_no, start, end):
+        # Holds a replica connection until the generator is exhausted or closed.
+        with replica.replica.connection() as conn:
+            days = conn.execute(
+                'SELECT day FROM gps_partitions WHERE day BETWEEN ? AND ? ORDER BY day',
+                (start[:10], end[:10])).fetchall()
+            for (day,) in days:
+                # Served entirely from the covering (bus_no, timestamp, latitude,
+                # longitude) index of one day table.
+                cur = conn.execute('''
+                    SELECT timestamp, latitude, longitude FROM %s
+                    WHERE bus_no = ? AND timestamp BETWEEN ? AND ?
+                    ORDER BY timestamp
+                ''' % partitions.table_name(day), (bus_no, start, end))
+                while True:
+                    rows = cur.fetchmany(FETCH_SIZE)
+                    if not rows:
+                        break
+                    yield from rows
+
+
+def migrate():
+    if BACKEND == 'postgres':
+        pgstore.backend.migrate()
+        return
+    with db.pool.connection() as conn:
+        migrations.migrate(conn)
+
+
+if BACKEND == 'sqlite':
+    routes = SQLiteRouteStore()
+    buses = SQLiteBusStore()
+    telemetry = SQLiteTelemetryStore()
+elif BACKEND == 'postgres':
+    import pgstore
+    routes = pgstore.PostgresRouteStore(pgstore.backend)
+    buses = pgstore.PostgresBusStore(pgstore.backend)
+    telemetry = pgstore.PostgresTelemetryStore(pgstore.backend)
+else:
+    raise ValueError('unknown SMARTBUS_STORAGE %r' % BACKEND)
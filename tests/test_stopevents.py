@@ -0,0 +1,68 @@
+import json
+import time
+
+import pytest
+
+import db
+import fleet
+import geometry
+import ingest
+import migrations
+import partitions
+import replica
+import spatial
+import stopevents
+import storage
+
+STOPS = [{'name': 'Majestic', 'lat': 12.97, 'lng': 77.59},
+         {'name': 'Corporation', 'lat': 12.97, 'lng': 77.60}]
+BETWEEN = (12.97, 77.595)
+
+
+@pytest.fixture
+def processor(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, 'pool', db.ConnectionPool(str(tmp_path / 'routes.db')))
+    monkeypatch.setattr(replica, 'replica', replica.Replica(mode='live'))
+    monkeypatch.setattr(partitions, 'partitions', partitions.Partitions())
+    monkeypatch.setattr(geometry, 'routes', geometry.RouteCache())
+    monkeypatch.setattr(spatial, 'stops', spatial.StopIndex(geometry.routes))
+    monkeypatch.setattr(fleet, 'assignments', fleet.Assignments())
+    with db.pool.connection() as conn:
+        migrations.migrate(conn)
+    storage.routes.add('R1', json.dumps(STOPS))
+    storage.buses.add('KA01', 'R1')
+    return stopevents.Processor(interval=1)
+
+
+def store(fixes):
+    # Written in list order, so ids follow the list, not the timestamps.
+    storage.SQLiteTelemetryStore().write([
+        ingest.Ping('KA01', lat, lng, None, None, ingest.utc_timestamp(t)) for t, lat, lng in fixes])
+
+
+def at(stop):
+    return STOPS[stop]['lat'], STOPS[stop]['lng']
+
+
+def stored_events():
+    with db.pool.connection() as conn:
+        rows = stopevents.events(conn, 'R1')
+    return [(e['stop_index'], e['event'], e['timestamp']) for e in reversed(rows)]
+
+
+def test_out_of_order_batch_is_replayed_in_time_order(processor):
+    t0 = time.time() - 600
+    store([(t0 + 180, *at(1)), (t0, *at(0)), (t0 + 60, *BETWEEN)])
+
+    assert processor.run_once() == 3
+    assert stored_events() == [
+        (0, stopevents.ARRIVAL, ingest.utc_timestamp(t0)),
+        (0, stopevents.DEPARTURE, ingest.utc_timestamp(t0 + 60)),
+        (1, stopevents.ARRIVAL, ingest.utc_timestamp(t0 + 180)),
+    ]
+
+    # A late replay of an older fix in a later batch is skipped.
+    store([(t0 + 30, *at(0))])
+    assert processor.run_once() == 1
+    assert len(stored_events()) == 3
+    assert processor.stats()['skipped'] == 1
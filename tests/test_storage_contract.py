@@ -0,0 +1,175 @@
+"""The same contract for every storage backend.
+
+Postgres runs against SMARTBUS_TEST_PG_DSN and is skipped when that is
+unset, psycopg is missing or the server can't be reached. Its tables are
+emptied first, so point it at a scratch database.
+"""
+import json
+import os
+import time
+
+import pytest
+
+import db
+import ingest
+import migrations
+import partitions
+import replica
+import storage
+
+PG_DSN = os.environ.get('SMARTBUS_TEST_PG_DSN')
+
+PATH = json.dumps([{'name': 'Majestic', 'lat': 12.9767, 'lng': 77.5713},
+                   {'name': 'MG_Road', 'lat': 12.9756, 'lng': 77.6066}])
+
+
+def sqlite_stores(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, 'pool', db.ConnectionPool(str(tmp_path / 'routes.db')))
+    monkeypatch.setattr(replica, 'replica', replica.Replica(mode='live'))
+    # Which day tables exist is cached per process, not per file.
+    monkeypatch.setattr(partitions, 'partitions', partitions.Partitions())
+    with db.pool.connection() as conn:
+        migrations.migrate(conn)
+    return storage.SQLiteRouteStore(), storage.SQLiteBusStore(), storage.SQLiteTelemetryStore()
+
+
+def postgres_stores(tmp_path, monkeypatch):
+    if not PG_DSN:
+        pytest.skip('SMARTBUS_TEST_PG_DSN is not set')
+    pgstore = pytest.importorskip('pgstore')
+    if pgstore.psycopg is None:
+        pytest.skip('psycopg is not installed')
+    backend = pgstore.PostgresBackend(PG_DSN, size=2)
+    try:
+        with backend.connection() as conn:
+            conn.execute('SELECT 1')
+    except Exception as e:
+        backend.close()
+        pytest.skip('postgres unavailable: %s' % e)
+    backend.migrate()
+    with backend.connection() as conn:
+        conn.execute('TRUNCATE routes, buses, gps_data, bus_status, bus_latest RESTART IDENTITY')
+    return (pgstore.PostgresRouteStore(backend), pgstore.PostgresBusStore(backend),
+            pgstore.PostgresTelemetryStore(backend))
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def stores(request, tmp_path, monkeypatch):
+    factory = sqlite_stores if request.param == 'sqlite' else postgres_stores
+    routes, buses, telemetry = factory(tmp_path, monkeypatch)
+    yield routes, buses, telemetry
+    backend = getattr(routes, 'backend', None)
+    if backend is not None:
+        backend.close()
+
+
+def ping(bus_no, t, lat=12.97, lng=77.59, air_quality=40, passengers=10):
+    return ingest.Ping(bus_no, lat, lng, air_quality, passengers, ingest.utc_timestamp(t))
+
+
+def test_routes_add_and_conflict(stores):
+    routes, _, _ = stores
+    routes.add('500D', PATH)
+    routes.add('335E', '[]')
+    with pytest.raises(storage.Conflict):
+        routes.add('500D', '[]')
+    assert [(r[1], r[2]) for r in routes.all()] == [('500D', PATH), ('335E', '[]')]
+
+
+def test_buses_add_delete_and_conflict(stores):
+    routes, buses, _ = stores
+    routes.add('500D', PATH)
+    buses.add('KA01', '500D')
+    buses.add('KA02', '500D')
+    with pytest.raises(storage.Conflict):
+        buses.add('KA01', '500D')
+    rows = buses.all()
+    assert [(r[1], r[2]) for r in rows] == [('KA01', '500D'), ('KA02', '500D')]
+    buses.delete(rows[0][0])
+    assert [r[1] for r in buses.all()] == ['KA02']
+
+
+def test_search_pages_and_matches_literally(stores):
+    routes, buses, _ = stores
+    routes.add('500D', PATH)
+    routes.add('335E', 'not json')
+    for bus_no in ('KA02', 'KA03', 'KA9%'):
+        buses.add(bus_no, '500D')
+    buses.add('KA04', '335E')
+
+    total, rows = buses.search(page=1, per_page=3)
+    assert total == 4
+    assert [r['bus_no'] for r in rows] == ['KA04', 'KA02', 'KA03']
+    assert rows[0]['stops'] == []
+    assert rows[1]['stops'] == ['Majestic', 'MG_Road']
+    assert rows[1]['route_no'] == '500D' and rows[1]['route_id'] is not None
+    total, rows = buses.search(page=2, per_page=3)
+    assert total == 4 and [r['bus_no'] for r in rows] == ['KA9%']
+
+    assert buses.search('%')[0] == 1
+    assert buses.search('mg_r')[0] == 3
+    assert buses.search('mgxr')[0] == 0
+    assert buses.search('335')[0] == 1
+
+
+def test_search_skips_path_entries_that_are_not_stops(stores):
+    routes, buses, _ = stores
+    routes.add('500D', PATH)
+    routes.add('600A', json.dumps(['x', 'y', {'name': 'Hebbal'}]))
+    buses.add('KA01', '500D')
+    buses.add('KA02', '600A')
+
+    total, rows = buses.search()
+    assert total == 2
+    assert rows[1]['stops'] == [None, None, 'Hebbal']
+    assert [r['bus_no'] for r in buses.search('hebbal')[1]] == ['KA02']
+    assert buses.search('x')[0] == 0
+
+
+def test_fingerprint_changes_with_buses_and_routes(stores):
+    routes, buses, _ = stores
+    before = buses.fingerprint()
+    routes.add('500D', PATH)
+    after_route = buses.fingerprint()
+    buses.add('KA01', '500D')
+    assert len({before, after_route, buses.fingerprint()}) == 3
+
+
+def test_telemetry_latest_since_and_fixes(stores):
+    _, _, telemetry = stores
+    now = time.time()
+    telemetry.write([ping('KA01', now - 20, lng=77.58), ping('KA02', now - 15)])
+    telemetry.write([ping('KA01', now - 10, lng=77.60, air_quality=55, passengers=12)],
+                    heartbeats=[ping('KA02', now - 5)])
+
+    rows, last_id = telemetry.latest()
+    latest = {r[0]: r for r in rows}
+    assert set(latest) == {'KA01', 'KA02'}
+    assert latest['KA01'][2] == pytest.approx(77.60)
+    assert latest['KA01'][3] == ingest.utc_timestamp(now - 10)
+    assert latest['KA01'][4:] == (55, 12)
+
+    history = telemetry.since(0)
+    assert [r[1] for r in history] == ['KA01', 'KA02', 'KA01']
+    assert history[-1][0] == last_id
+    assert [r[0] for r in history] == sorted(r[0] for r in history)
+    assert telemetry.since(last_id) == []
+
+    fixes = list(telemetry.fixes('KA01', ingest.utc_timestamp(now - 60), ingest.utc_timestamp(now)))
+    assert [f[0] for f in fixes] == [ingest.utc_timestamp(now - 20), ingest.utc_timestamp(now - 10)]
+    assert fixes[0][2] == pytest.approx(77.58)
+
+
+def test_replayed_ping_keeps_newer_latest(stores):
+    _, _, telemetry = stores
+    now = time.time()
+    telemetry.write([ping('KA01', now - 10, lng=77.60, air_quality=55)])
+    telemetry.write([ping('KA01', now - 30, lng=77.50, air_quality=99)])
+
+    rows, _ = telemetry.latest()
+    assert len(rows) == 1
+    assert rows[0][2] == pytest.approx(77.60)
+    assert rows[0][3] == ingest.utc_timestamp(now - 10)
+    assert rows[0][4] == 55
+    # The replayed fix is still history.
+    assert len(telemetry.since(0)) == 2